@@ -10,10 +10,36 @@ import os
 import sys
 import re
 import subprocess
+import asyncio
 from datetime import datetime
 import shutil
 import argparse
 import logging
+import threading
+import json
+import hashlib
+import zlib
+import time
+import math
+import random
+import socket
+import shlex
+import struct
+import zipfile
+import sqlite3
+from contextlib import closing
+import errno
+import fcntl
+import csv
+import queue
+import signal
+import stat
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Default variables, they will be set in the configuration file
 variables = dict()
@@ -28,6 +54,8 @@ variables["megantools"] = "tools"
 variables["metaxa"] = "metaxa2"
 
 variables["diamondindex"] = "diamond.dmnd"
+# align both mates of a sample with one DIAMOND run (one DAA file with mate-tagged read names) instead of one run per mate
+variables["diamondpaired"] = True
 variables["taxonomy"] = "megan-nucl.db"
 variables["mdb"] = "megan-map.db"
 
@@ -40,6 +68,9 @@ variables["maxeval"] = 0.0
 variables["minsupp"] = 0.0
 
 variables["keepraw"] = True
+# how raw files are put into 00_RAW if they are kept: auto (reflink or hardlink if the output directory is on the same
+# file system, a symlink otherwise), reflink, hardlink, symlink or copy
+variables["staging"] = "auto"
 
 variables["hostDB"] = "host"
 
@@ -51,25 +82,148 @@ variables["malteval"] = 0.0
 variables["maltsupp"] = 0.0
 variables["maxeval"] = 0.0
 variables["maltbase"] = "malt"
+# number of read files (of any samples) aligned by one malt-run, so the index is loaded once for all of them
+# (1 runs MALT for every file on its own), and how many seconds to wait for a batch to fill up
+variables["maltbatch"] = 1
+variables["maltbatchwait"] = 60
 
 # Allow to name the analysis (name of logfile, mainly)
 variables["name"] = "MAPle"
 
 variables["raw2trimloss"] = 0.6
 variables["rawabsolute"] = 10000
+# stop reading the raw data for the raw QC breakpoint once rawabsolute reads were seen
+# (the full read count is then collected while trimming runs)
+variables["rawearlystop"] = False
+# FastQC is not needed for the breakpoints anymore, it only writes the reports
+variables["fastqcreport"] = True
+
+# stream the reads from prinseq++ through named pipes into the tools reading the trimmed reads (streamto: diamond,
+# filterHost, select16S, fastqc) instead of writing them to disk and reading them again. The trimmed reads are only
+# written to 01_trimmed with keeptrimmed = True or if a tool that reads them is not streamed.
+variables["streamtrimmed"] = False
+variables["streamto"] = "diamond,filterHost,select16S,fastqc"
+variables["keeptrimmed"] = False
+
+# collapse identical read pairs before the alignments (dedup), the unique pairs carry their number of copies in their
+# names (;weight=N) and daa2rma and MALT count them that often (-mag). Duplicates are found bucket by bucket, a bucket
+# holds about dedupmemory MB of reads.
+variables["dedup"] = False
+variables["dedupmemory"] = 512
+
+# QC metrics of all runs (read statistics of the raw, trimmed and host filtered reads, FastQC reports) are kept in
+# an SQLite database, relative paths are relative to the output directory. Several output directories can share one.
+variables["qcstore"] = "qc.sqlite"
+# identifier of the current run in the QC store, set when the run starts
+variables["run"] = ""
+
+# intermediates (trimmed and collapsed reads, host filtered reads, selected 16S reads) are written as block
+# compressed gzip files (BGZF) by several threads, with compression level compresslevel
+variables["compress"] = True
+variables["compresslevel"] = 1
+
+# sample x taxon abundance matrices (05_abundance/<source>.npz) from the metaxa2 taxonomy (16S), the MALT 16S
+# alignments (16Smalt) and the MEGAN files of the basic (basic) and host filtered (host) alignments. The metaxa2
+# taxonomy is cut after abundancelevel ranks (0: full path).
+variables["abundance"] = True
+variables["abundancelevel"] = 6
 
 # Modules
 variables["basic"] = True
 variables["filterHost"] = False
 variables["16S"] = False
 
+# Core budget, split between samples running at the same time and the threads of each tool call
+# (0 means: all cores of this machine / choose the number of concurrent samples automatically)
+variables["cores"] = 0
+variables["workers"] = 0
+variables["threads"] = 1
+
+# Tool calls: seconds a tool may run before it is stopped (0: no limit), per stage or tool as "name:seconds,...",
+# how often a failed call is repeated and the delay before the first repetition (doubled for every further one)
+variables["timeout"] = 0
+variables["timeouts"] = ""
+variables["retries"] = 0
+variables["retrydelay"] = 30
+
+# Memory budget in GB for all stages running at the same time (0: the physical memory of this machine) and the memory
+# a stage needs, per stage or tool as "name:GB,..." (e.g. diamond:48,filterHost:64). Stages without an estimate use
+# the peak memory measured in an earlier run of the same output directory or memdefault.
+variables["memory"] = 0
+variables["memestimates"] = ""
+variables["memdefault"] = 1
+
+# Result cache shared by all runs and projects using the same directory ("" disables it), its size limit in GB
+# (0: no limit; the least recently used results are removed first)
+variables["cachedir"] = ""
+variables["cachesize"] = 0
+
+# Watch mode: seconds between two polls of the input directory, seconds without new samples after which watching
+# ends (0: only the sentinel ends it) and the file that marks the end of the sequencing run in the input directory
+variables["watchinterval"] = 30
+variables["watchidle"] = 3600
+variables["watchsentinel"] = "MAPLE_DONE"
+
+# Where the samples are processed: local (worker threads on this machine) or batch (one job per sample submitted to
+# a SLURM-style scheduler with batchsubmit; "local" starts the jobs as background processes on this machine instead).
+# A job gets batchcores cores, batchoptions are added to its job script (e.g. "--partition=long --time=24:00:00"),
+# the state of the jobs is checked every batchpoll seconds. A job whose state file does not change is looked up with
+# batchstatus and the job ID batchsubmit printed; if the scheduler no longer knows it or lists it as ended, it failed.
+variables["executor"] = "local"
+variables["batchsubmit"] = "sbatch"
+variables["batchcores"] = 8
+variables["batchoptions"] = ""
+variables["batchpoll"] = 10
+variables["batchstatus"] = "squeue -h -o %T -j"
+
+# scheduler states of jobs that ended (SLURM)
+endedStates = set(["COMPLETED", "COMPLETING", "FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL", "OUT_OF_MEMORY",
+                   "PREEMPTED", "BOOT_FAIL", "DEADLINE"])
+
+# Per-thread state, mainly the name of the sample a worker is currently processing
+current = threading.local()
+
+# Index of the samples of the run: the raw read files of every sample and the paths of all files its stages write.
+# It is built once during setup, stored in the output directory and the only place later stages look up files.
+variables["manifest"] = "samples.json"
+manifest = dict()
+
+# Stage checkpoints of the run (see checkpoint), stored in the output directory
+variables["checkpoints"] = "checkpoints.json"
+checkpoints = dict()
+checkpointLock = threading.Lock()
+# stages (or tools) that are run again even if their checkpoint is still valid
+variables["force"] = set()
+
+# Resource usage of every tool call and the duration of every stage, written as run report at the end of the run
+variables["report"] = "run_report"
+report = {"commands": list(), "stages": list()}
+reportLock = threading.Lock()
+# peak memory measured per stage over all runs of the output directory (see MemoryBudget)
+variables["peaks"] = "memory_peaks.json"
+
+# config values that influence the results of a tool, stages are run again if one of them changes
+stageParams = dict()
+stageParams["fastqc"] = ["FASTQC"]
+stageParams["trim"] = ["prinseq", "trimwindow", "trimqual", "minlength", "lefttrim", "compress", "compresslevel"]
+stageParams["diamond"] = ["diamond", "diamondindex", "diamondpaired"]
+stageParams["daa2rma"] = ["megantools", "taxonomy", "mdb", "maxeval", "minsupp", "dedup"]
+stageParams["filterHost"] = ["malt", "hostDB", "minsupp", "maxeval", "dedup", "compress", "compresslevel"]
+stageParams["select16S"] = ["metaxa", "compress", "compresslevel"]
+stageParams["malt"] = ["malt", "maltbase", "maltsupp", "malteval", "dedup"]
+stageParams["dedup"] = ["compress", "compresslevel"]
+stageParams["taxonomy16S"] = ["abundancelevel"]
+stageParams["rma2info"] = ["megantools"]
+stageParams["stream"] = stageParams["trim"] + ["streamto", "keeptrimmed"] + stageParams["diamond"] + \
+                        stageParams["filterHost"] + stageParams["select16S"] + stageParams["fastqc"]
+
 #global loghandle
 
 
 # read in configuration file
 def readConfig(config):
     print("Reading configuration file."),
-    with open(config, 'rU') as c:
+    with open(config, 'r') as c:
         print("."),
         for line in c:
             if not (line.startswith("#")) and not (line == "\n"):
@@ -94,30 +248,1082 @@ def readConfig(config):
         variables["16S"] = False
     else:
         variables["16S"] = True
+    variables["rawearlystop"] = str(variables["rawearlystop"]) == "True"
+    variables["diamondpaired"] = str(variables["diamondpaired"]) != "False"
+    variables["fastqcreport"] = str(variables["fastqcreport"]) != "False"
+    variables["streamtrimmed"] = str(variables["streamtrimmed"]) == "True"
+    variables["dedup"] = str(variables["dedup"]) == "True"
+    variables["abundance"] = str(variables["abundance"]) == "True"
+    variables["compress"] = str(variables["compress"]) == "True"
+    variables["compresslevel"] = int(variables["compresslevel"])
+    variables["abundancelevel"] = int(variables["abundancelevel"])
+    variables["dedupmemory"] = float(variables["dedupmemory"])
+    variables["keeptrimmed"] = str(variables["keeptrimmed"]) == "True"
+    if isinstance(variables["streamto"], str):
+        variables["streamto"] = [t.strip() for t in variables["streamto"].split(",") if t.strip() != ""]
 
     variables["rawabsolute"] = int(variables["rawabsolute"])
     variables["raw2trimloss"] = float(variables["raw2trimloss"])
+    variables["cores"] = int(variables["cores"])
+    variables["workers"] = int(variables["workers"])
+    variables["maltbatch"] = int(variables["maltbatch"])
+    variables["maltbatchwait"] = float(variables["maltbatchwait"])
+    variables["timeout"] = float(variables["timeout"])
+    if isinstance(variables["timeouts"], str):
+        timeouts = dict()
+        for t in variables["timeouts"].split(","):
+            if ":" in t:
+                name, seconds = t.split(":")
+                timeouts[name.strip()] = float(seconds)
+        variables["timeouts"] = timeouts
+    variables["retries"] = int(variables["retries"])
+    variables["memory"] = float(variables["memory"])
+    variables["cachesize"] = float(variables["cachesize"])
+    variables["watchinterval"] = float(variables["watchinterval"])
+    variables["batchcores"] = int(variables["batchcores"])
+    variables["batchpoll"] = float(variables["batchpoll"])
+    variables["watchidle"] = float(variables["watchidle"])
+    if variables["cachedir"] != "":
+        variables["cachedir"] = os.path.abspath(variables["cachedir"])
+    variables["memdefault"] = float(variables["memdefault"])
+    if isinstance(variables["memestimates"], str):
+        estimates = dict()
+        for t in variables["memestimates"].split(","):
+            if ":" in t:
+                name, gb = t.split(":")
+                estimates[name.strip()] = float(gb)
+        variables["memestimates"] = estimates
+    variables["retrydelay"] = float(variables["retrydelay"])
     print(".")
 
 
+# split the core budget into concurrent samples and threads per tool call
+def coreBudget(nsamples):
+    cores = variables["cores"]
+    if cores <= 0:
+        cores = os.cpu_count() or 1
+    workers = variables["workers"]
+    if workers <= 0:
+        # aligners scale well up to a few threads each, so do not give a sample less than 8 cores
+        workers = max(1, cores // 8)
+    workers = max(1, min(workers, nsamples, cores))
+    variables["cores"] = cores
+    variables["workers"] = workers
+    variables["threads"] = max(1, cores // workers)
+    return workers, variables["threads"]
+
+
+# number of threads the tool started by the current thread may use
+def toolThreads():
+    return getattr(current, "threads", None) or variables["threads"]
+
+
+# add the sample that is processed by the current thread to every log record,
+# optionally only letting through the records of one sample
+class SampleFilter(logging.Filter):
+    def __init__(self, samplename=None):
+        logging.Filter.__init__(self)
+        self.samplename = samplename
+
+    def filter(self, record):
+        # records logged for a sample by another thread (e.g. the tool engine) name it themselves
+        if getattr(record, "sample", None) is None:
+            record.sample = getattr(current, "sample", None) or "-"
+        return self.samplename is None or record.sample == self.samplename
+
+
+# separate log file for every sample, it only receives the lines logged while working on that sample
+def sampleLog(samplename):
+    if not os.path.exists(os.getcwd() + "/logs"):
+        os.makedirs(os.getcwd() + "/logs", exist_ok=True)
+    handler = logging.FileHandler("logs/" + samplename + ".log", 'w', 'utf-8')
+    handler.setFormatter(logging.Formatter('%(name)s %(message)s'))
+    handler.addFilter(SampleFilter(samplename))
+    logging.getLogger().addHandler(handler)
+    return handler
+
+
+# a tool that failed (after all repetitions), timed out or was stopped
+class ToolError(Exception):
+    def __init__(self, args, returncode, timedout=False, stopped=False):
+        self.command = args
+        self.returncode = returncode
+        self.timedout = timedout
+        self.stopped = stopped
+        if timedout:
+            reason = "timed out"
+        elif stopped:
+            reason = "was stopped"
+        else:
+            reason = "exited with status " + str(returncode)
+        Exception.__init__(self, "Command " + " ".join(args) + " " + reason)
+
+
+# Runs all tool calls on an asyncio event loop in a background thread, so any number of tools of all samples run at
+# the same time without a thread per pipe. The output of a tool is streamed into the log files of its sample as it
+# arrives. Tools are stopped when they exceed their timeout and repeated with increasing delays if they fail.
+# The exit of a tool is still collected by waitCommand (in a thread of the engine) for its resource usage.
+class ToolEngine:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.waiters = None
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.waiters = ThreadPoolExecutor(max_workers=256, thread_name_prefix="toolwait")
+                threading.Thread(target=self.loop.run_forever, name="toolengine", daemon=True).start()
+
+    # run a tool from any thread and wait for it, returns the records of all attempts
+    def run(self, args, context):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.execute(args, context), self.loop).result()
+
+    async def execute(self, args, context):
+        attempts = list()
+        while True:
+            record = await self.attempt(args, context)
+            attempts.append(record)
+            if record["returncode"] == 0 or record["stopped"] or len(attempts) > context["retries"]:
+                return attempts
+            delay = variables["retrydelay"] * 2 ** (len(attempts) - 1)
+            logging.warning("Command " + args[0] + " failed (" + str(record["returncode"]) + "), trying again in " +
+                            str(delay) + " s\n", extra={"sample": context["sample"]})
+            await asyncio.sleep(delay)
+
+    async def attempt(self, args, context):
+        sample = context["sample"]
+        start = time.time()
+        # every tool gets its own process group, so a timeout also stops the processes it started (e.g. the JVM
+        # behind malt-run)
+        if sample is None:
+            command = subprocess.Popen(args, start_new_session=True)
+        else:
+            command = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, start_new_session=True)
+        command.stopped = False
+        if context["processes"] is not None:
+            context["processes"].append(command)
+        pumps = list()
+        if sample is not None:
+            pumps.append(asyncio.ensure_future(self.pump(command.stdout, "logs/" + sample + ".stdout.log")))
+            pumps.append(asyncio.ensure_future(self.pump(command.stderr, "logs/" + sample + ".stderr.log")))
+        waiter = self.loop.run_in_executor(self.waiters, waitCommand, command)
+        timedout = False
+        try:
+            usage, io = await asyncio.wait_for(asyncio.shield(waiter), context["timeout"] or None)
+        except asyncio.TimeoutError:
+            timedout = True
+            logging.error("Command " + args[0] + " exceeded its timeout of " + str(context["timeout"]) + " s\n",
+                          extra={"sample": sample})
+            signalCommand(command, signal.SIGTERM)
+            try:
+                usage, io = await asyncio.wait_for(asyncio.shield(waiter), 30)
+            except asyncio.TimeoutError:
+                signalCommand(command, signal.SIGKILL)
+                usage, io = await waiter
+        if command.returncode != 0:
+            # a failed tool must not leave processes behind that still run when it is repeated
+            killGroup(command, signal.SIGKILL)
+        if len(pumps) > 0:
+            # processes the tool left behind may keep its output open
+            drain = asyncio.gather(*pumps)
+            try:
+                await asyncio.wait_for(asyncio.shield(drain), 5 if timedout else 30)
+            except asyncio.TimeoutError:
+                logging.warning("Stopping the processes " + args[0] + " left behind\n", extra={"sample": sample})
+                killGroup(command, signal.SIGKILL)
+                try:
+                    await asyncio.wait_for(drain, 5)
+                except asyncio.TimeoutError:
+                    pass
+        record = {"sample": sample or "-", "stage": context["stage"] or "-", "tool": os.path.basename(args[0]),
+                  "command": " ".join(args), "start": str(datetime.fromtimestamp(start)),
+                  "wall": round(time.time() - start, 3), "returncode": command.returncode}
+        record["user"] = round(usage.ru_utime, 3) if usage is not None else None
+        record["sys"] = round(usage.ru_stime, 3) if usage is not None else None
+        # ru_maxrss is in kB on Linux
+        record["maxrss"] = usage.ru_maxrss if usage is not None else None
+        for key in ("rchar", "wchar", "read_bytes", "write_bytes"):
+            record[key] = io.get(key)
+        record["timedout"] = timedout
+        record["stopped"] = command.stopped
+        return record
+
+    # copy the output of a tool into a log file while it runs
+    async def pump(self, pipe, path):
+        reader = asyncio.StreamReader()
+        transport, protocol = await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            with open(path, 'ab') as log:
+                data = await reader.read(1 << 16)
+                while len(data) > 0:
+                    log.write(data)
+                    log.flush()
+                    data = await reader.read(1 << 16)
+        finally:
+            transport.close()
+
+
+toolEngine = ToolEngine()
+
+
+# seconds the current stage (or the tool) may run, 0 means no limit
+def toolTimeout(tool):
+    stage = getattr(current, "stage", None)
+    for name in (stage, tool):
+        if name in variables["timeouts"]:
+            return variables["timeouts"][name]
+    return variables["timeout"]
+
+
+# run an external tool, stdout and stderr go to the log files of the sample that is currently processed.
+# A tool that fails (after all repetitions) raises a ToolError, this fails the stage and skips all stages depending
+# on it.
+# Every call is measured: wall time, CPU time and peak memory of the tool (including the processes it started) and
+# the bytes it read and wrote, these go into the run report.
+def runCommand(args):
+    context = {"sample": getattr(current, "sample", None), "stage": getattr(current, "stage", None),
+               "processes": getattr(current, "processes", None), "timeout": toolTimeout(os.path.basename(args[0])),
+               "retries": variables["retries"]}
+    pipes = getattr(current, "pipes", False)
+    if pipes:
+        # the named pipes of the tool are used up by an attempt, pipedAttempts repeats it with new ones
+        context["retries"] = 0
+        if pipes == "stream" and variables["retries"] > 0:
+            logging.warning("Command " + args[0] + " reads the stream of the trimmed reads, it is not repeated if "
+                            "it fails\n")
+    attempts = toolEngine.run(args, context)
+    with reportLock:
+        report["commands"].extend(attempts)
+    memoryBudget.measure(attempts)
+    last = attempts[-1]
+    returncode = last["returncode"]
+    if getattr(current, "returncodes", None) is not None:
+        current.returncodes.append(returncode)
+    if returncode != 0:
+        logging.warning("Command " + args[0] + " exited with status " + str(returncode) + "\n")
+        raise ToolError(args, returncode, last["timedout"], last["stopped"])
+    return returncode
+
+
+# run fn, which sets up named pipes and runs a tool on them. A failed attempt uses up the pipes, so the tool is repeated
+# (retries, retrydelay as in ToolEngine.execute) by calling fn again with new pipes. Within the pipes of an outer call
+# or the streaming stage fn runs once.
+def pipedAttempts(fn):
+    outer = getattr(current, "pipes", False)
+    returncodes = getattr(current, "returncodes", None)
+    first = len(returncodes) if returncodes is not None else 0
+    attempts = 0
+    while True:
+        current.pipes = outer or True
+        try:
+            return fn()
+        except ToolError as e:
+            attempts += 1
+            if outer or e.stopped or attempts > variables["retries"]:
+                raise
+            delay = variables["retrydelay"] * 2 ** (attempts - 1)
+            logging.warning("Command " + e.command[0] + " failed (" + str(e.returncode) + "), trying again with new "
+                            "pipes in " + str(delay) + " s\n")
+            # only the exit status of the last attempt counts for the checkpoint
+            if returncodes is not None:
+                del returncodes[first:]
+            time.sleep(delay)
+        finally:
+            current.pipes = outer
+
+
+# send a signal to a tool and the processes it started unless it already exited (Popen.send_signal would reap it
+# behind the back of waitCommand)
+def signalCommand(command, sig):
+    if command.returncode is None:
+        killGroup(command, sig)
+
+
+# send a signal to the process group of a tool, it is gone once the tool and all processes it started exited
+def killGroup(command, sig):
+    try:
+        os.killpg(command.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+# stop tools collected by the current thread that are still running (see runCommand and streamWorker)
+def stopCommands(processes):
+    for command in processes:
+        command.stopped = True
+        signalCommand(command, signal.SIGTERM)
+
+
+# wait for a tool and collect its resource usage. The process is only reaped after its I/O counters were read,
+# both include the processes it started and waited for (e.g. the JVM behind malt-run).
+def waitCommand(command):
+    if not hasattr(os, "waitid") or not hasattr(os, "wait4"):
+        command.wait()
+        return None, dict()
+    os.waitid(os.P_PID, command.pid, os.WEXITED | os.WNOWAIT)
+    io = dict()
+    try:
+        with open("/proc/" + str(command.pid) + "/io", 'r') as f:
+            for line in f:
+                key, value = line.split(":")
+                io[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    pid, status, usage = os.wait4(command.pid, 0)
+    command.returncode = os.waitstatus_to_exitcode(status)
+    return usage, io
+
+
+# Collects MALT jobs of all samples into batches that share one malt-run call (MALT accepts several input files and
+# writes one output per input, in the same order). Jobs with the same options (database, mode, thresholds) are
+# batched together. The first sample of a batch waits until it is full, maltbatchwait has passed or no other sample
+# can still join it, runs MALT and hands the exit status to the other samples of the batch.
+class MaltBatcher:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.pending = dict()
+        # samples being processed and the samples that already sent their jobs per options, a sample that is
+        # processed and did not send its jobs yet may still join a batch
+        self.active = set()
+        self.joined = dict()
+
+    def begin(self, s):
+        with self.lock:
+            self.active.add(s)
+
+    def end(self, s):
+        with self.lock:
+            self.active.discard(s)
+            self.lock.notify_all()
+
+    def joinable(self, key):
+        return len(self.active - self.joined[key]) > 0
+
+    # jobs are dicts with the input file and the "rma", "unaligned" and "aligned" output files for it
+    def run(self, options, jobs):
+        if variables["maltbatch"] <= 1:
+            return self.execute(options, jobs)
+        key = tuple(options)
+        entry = {"jobs": jobs, "done": threading.Event(), "status": None, "sample": getattr(current, "sample", None)}
+        with self.lock:
+            batch = self.pending.setdefault(key, list())
+            batch.append(entry)
+            self.joined.setdefault(key, set()).add(entry["sample"])
+            leader = len(batch) == 1
+            self.lock.notify_all()
+            if leader:
+                deadline = time.time() + variables["maltbatchwait"]
+                while sum(len(e["jobs"]) for e in batch) < variables["maltbatch"] and time.time() < deadline and \
+                        self.joinable(key):
+                    self.lock.wait(deadline - time.time())
+                del self.pending[key]
+        if not leader:
+            entry["done"].wait()
+            logging.info("MALT ran in a batch started by sample " + str(entry["leader"]) + "\n")
+            if getattr(current, "returncodes", None) is not None:
+                current.returncodes.append(entry["status"])
+            if entry["status"] != 0:
+                raise ToolError([variables["malt"]] + options, entry["status"])
+            return entry["status"]
+        # the batch runs one malt-run, it gets one memory grant (the stages of the batch do not reserve memory)
+        granted = memoryBudget.acquire(current.stage, memoryBudget.estimate(current.stage, "malt"))
+        try:
+            alljobs = [job for e in batch for job in e["jobs"]]
+            logging.info("Running MALT on a batch of " + str(len(alljobs)) + " files from " + str(len(batch)) +
+                         " stages\n")
+            status = self.execute(options, alljobs)
+        except ToolError as e:
+            status = e.returncode
+            raise
+        except Exception:
+            status = -1
+            raise
+        finally:
+            memoryBudget.release(granted)
+            for e in batch:
+                e["status"] = status
+                e["leader"] = getattr(current, "sample", None)
+                e["done"].set()
+        return status
+
+    def execute(self, options, jobs):
+        command = [variables["malt"]] + options + ['-t', str(toolThreads()), '-i'] + [j["input"] for j in jobs]
+        command += ['-o'] + [j["rma"] for j in jobs]
+        if jobs[0].get("unaligned") is not None:
+            command += ['-ou'] + [j["unaligned"] for j in jobs]
+        if jobs[0].get("aligned") is not None:
+            command += ['-oa'] + [j["aligned"] for j in jobs]
+        return runCommand(command)
+
+
+maltBatcher = MaltBatcher()
+
+
+# Admission control: a stage only starts when the memory it needs fits into the memory budget next to the stages
+# already running. A stage needing more than the whole budget waits until nothing else runs and then runs alone.
+class MemoryBudget:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.used = 0.0
+        self.running = 0
+        # peak memory in GB measured per stage (in this run or earlier ones)
+        self.measured = dict()
+
+    def total(self):
+        if variables["memory"] > 0:
+            return variables["memory"]
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / float(1 << 30)
+
+    # memory in GB a stage (or a tool) is expected to need
+    def estimate(self, name, tool=None):
+        for n in (name, tool):
+            if n in variables["memestimates"]:
+                return variables["memestimates"][n]
+        with self.lock:
+            if name in self.measured:
+                # some headroom, the input of the next sample may be larger
+                return self.measured[name] * 1.2
+        return variables["memdefault"]
+
+    # wait until the stage fits into the budget, returns the memory granted to it
+    def acquire(self, name, need):
+        budget = self.total()
+        with self.lock:
+            if self.used + need > budget and self.running > 0:
+                logging.info("Stage " + name + " waits for " + str(round(need, 1)) + " GB of memory (" +
+                             str(round(budget - self.used, 1)) + " GB free)\n")
+            while self.running > 0 and self.used + need > budget:
+                self.lock.wait()
+            if need > budget:
+                logging.warning("Stage " + name + " needs " + str(round(need, 1)) + " GB, more than the memory " +
+                                "budget of " + str(round(budget, 1)) + " GB, running it alone\n")
+            self.used += need
+            self.running += 1
+        return need
+
+    def release(self, granted):
+        with self.lock:
+            self.used -= granted
+            self.running -= 1
+            self.lock.notify_all()
+
+    # remember the peak memory of finished tool calls (maxrss is in kB)
+    def measure(self, commands):
+        with self.lock:
+            for c in commands:
+                if c.get("maxrss") and c["stage"] != "-":
+                    gb = c["maxrss"] / float(1 << 20)
+                    self.measured[c["stage"]] = max(self.measured.get(c["stage"], 0.0), gb)
+
+    # peak memory of the stages measured in earlier runs. A rerun that skips its stages measures nothing, so the
+    # peaks are kept in a file of their own; run reports of older versions are read as well.
+    def load(self):
+        if os.path.exists(variables["report"] + ".json"):
+            try:
+                with open(variables["report"] + ".json", 'r') as r:
+                    self.measure(json.load(r).get("commands", []))
+            except ValueError:
+                pass
+        if os.path.exists(variables["peaks"]):
+            try:
+                with open(variables["peaks"], 'r') as p:
+                    peaks = json.load(p)
+            except ValueError:
+                peaks = dict()
+            with self.lock:
+                for stage, gb in peaks.items():
+                    self.measured[stage] = max(self.measured.get(stage, 0.0), gb)
+
+    # store the peaks of this and all earlier runs
+    def save(self):
+        with self.lock:
+            peaks = dict(self.measured)
+        with open(variables["peaks"] + ".tmp", 'w') as p:
+            json.dump(peaks, p, indent=1, sort_keys=True)
+        os.replace(variables["peaks"] + ".tmp", variables["peaks"])
+
+
+memoryBudget = MemoryBudget()
+
+
+# memory declared in memestimates for the stage of the current thread or the tool in GB. The settings of DIAMOND and
+# MALT are only derived from declared memory, a measured peak would make them smaller from run to run.
+def toolMemory(tool):
+    for name in (getattr(current, "stage", None), tool):
+        if name in variables["memestimates"]:
+            return variables["memestimates"][name]
+    return None
+
+
+# DIAMOND block size (-b, billions of sequence letters) and number of index chunks (-c) for the memory of the stage.
+# DIAMOND needs about 6 * b GB with the default of 4 chunks; a single chunk is faster and needs about twice as much.
+def diamondMemory():
+    mem = toolMemory("diamond")
+    if not mem:
+        return []
+    chunks = 4
+    block = mem / 6.0
+    if block >= 4.0:
+        chunks = 1
+        block = mem / 12.0
+    block = max(0.2, min(12.0, int(block * 10) / 10.0))
+    return ['-b', str(block), '-c', str(chunks)]
+
+
+# size of a MALT index in GB
+def indexSize(path):
+    size = 0
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size / float(1 << 30)
+
+
+# MALT memory mode: load the whole index if the memory of the stage holds it, otherwise page it in from disk
+def maltMemory(index):
+    mem = toolMemory("malt")
+    size = indexSize(index)
+    if mem and size > 0 and mem >= size * 1.1:
+        return ['-mem', 'load']
+    return ['-mem', 'page']
+
+
+# size and hash of a file, the hash covers the size and the first and last MB so large files stay cheap
+def fileHash(path):
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(1 << 20))
+        if size > 2 << 20:
+            f.seek(-(1 << 20), os.SEEK_END)
+            h.update(f.read(1 << 20))
+    return {"size": size, "hash": h.hexdigest()}
+
+
+# read the checkpoint manifest of an earlier run of this output directory
+def loadCheckpoints():
+    checkpoints.clear()
+    if os.path.exists(variables["checkpoints"]):
+        with open(variables["checkpoints"], 'r') as c:
+            checkpoints.update(json.load(c))
+
+
+# write the checkpoint manifest, the old one is only replaced once the new one is complete
+def saveCheckpoints():
+    with open(variables["checkpoints"] + ".tmp", 'w') as c:
+        json.dump(checkpoints, c, indent=1, sort_keys=True)
+    os.replace(variables["checkpoints"] + ".tmp", variables["checkpoints"])
+
+
+# run a stage unless its checkpoint shows it already finished with the same inputs and parameters.
+# Afterwards the inputs, parameters, exit status of the tools and the outputs are recorded.
+# The stage only gets its memory (need, in GB) from the memory budget when it really runs.
+def checkpoint(s, name, tool, inputs, outputs, fn, need=None):
+    key = s + "/" + name
+    params = dict((p, str(variables[p])) for p in stageParams.get(tool, []))
+    try:
+        state = dict((i, fileHash(i)) for i in inputs)
+    except OSError:
+        state = None
+    record = checkpoints.get(key)
+    if record is not None and state is not None and not (name in variables["force"] or tool in variables["force"]):
+        # the outputs of the record must be the ones the stage writes now (e.g. compressed or not)
+        if record["status"] == 0 and record["inputs"] == state and record["params"] == params and \
+                set(record["outputs"]) == set(outputs):
+            try:
+                if all(fileHash(o) == h for o, h in record["outputs"].items()):
+                    logging.info("Stage " + name + " of sample " + s + " is up to date, skipping it\n")
+                    return True
+            except OSError:
+                pass
+    cachekey = cacheKey(tool, inputs)
+    if cachekey is not None and fetchCache(cachekey, outputs):
+        logging.info("Stage " + name + " of sample " + s + " was taken from the cache\n")
+        result = True
+        returncodes = list()
+    else:
+        if cachekey is not None:
+            # outputs linked to the cache must not be overwritten in place
+            for o in outputs:
+                if os.path.exists(o) and os.stat(o).st_nlink > 1:
+                    os.remove(o)
+        current.returncodes = list()
+        granted = memoryBudget.acquire(name, need) if need is not None else None
+        try:
+            result = fn()
+        finally:
+            if granted is not None:
+                memoryBudget.release(granted)
+            returncodes = current.returncodes
+            current.returncodes = None
+    status = 0
+    for r in returncodes:
+        if r != 0:
+            status = r
+            break
+    record = {"tool": tool, "inputs": state or dict(), "params": params, "status": status, "outputs": dict(),
+              "finished": str(datetime.now())}
+    missing = list()
+    for o in outputs:
+        if os.path.exists(o):
+            record["outputs"][o] = fileHash(o)
+        else:
+            missing.append(o)
+    if len(missing) > 0 and status == 0:
+        # a tool that does not produce its output did not work, even if it says so
+        logging.warning("Stage " + name + " of sample " + s + " did not produce " + ", ".join(missing) + "\n")
+        record["status"] = -1
+    with checkpointLock:
+        checkpoints[key] = record
+        saveCheckpoints()
+    if cachekey is not None and record["status"] == 0 and len(returncodes) > 0:
+        storeCache(cachekey, tool, key, outputs)
+    if len(missing) > 0 and result is not False:
+        # the stages depending on this one would run on files that do not exist (a stage stopped by a breakpoint
+        # returns False and is expected to leave its outputs unwritten)
+        raise IOError("Stage " + name + " of sample " + s + " did not produce " + ", ".join(missing))
+    return result
+
+
+# Content-addressed result cache: the outputs of the alignment stages are stored under a key made from the content of
+# their inputs, the version of the tool, the identity of its databases and the parameters that change the results.
+# Results are hardlinked into and out of the cache, so a cached result takes no extra space.
+# tool of a stage: (executable, databases)
+cacheTools = dict()
+cacheTools["diamond"] = ("diamond", ["diamondindex"])
+cacheTools["daa2rma"] = ("megantools", ["taxonomy", "mdb"])
+cacheTools["filterHost"] = ("malt", ["hostDB"])
+cacheTools["malt"] = ("malt", ["maltbase"])
+cacheLock = threading.Lock()
+identities = dict()
+
+
+# full content hash of a file
+def contentHash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        data = f.read(statsBlock)
+        while len(data) > 0:
+            h.update(data)
+            data = f.read(statsBlock)
+    return h.hexdigest()
+
+
+# identity of a database or executable (file or directory): its real path, size and modification time
+def fileIdentity(path):
+    path = shutil.which(path) or path
+    if not os.path.exists(path):
+        return path
+    path = os.path.realpath(path)
+    size = 0
+    mtime = 0
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                st = os.stat(os.path.join(root, f))
+                size += st.st_size
+                mtime = max(mtime, int(st.st_mtime))
+    else:
+        st = os.stat(path)
+        size = st.st_size
+        mtime = int(st.st_mtime)
+    return path + ":" + str(size) + ":" + str(mtime)
+
+
+# version of a tool, DIAMOND reports it, for MALT and MEGAN the identity of the executable is used
+def toolVersion(executable):
+    with cacheLock:
+        if executable in identities:
+            return identities[executable]
+    version = fileIdentity(executable)
+    if executable == variables["diamond"]:
+        try:
+            version = subprocess.run([executable, 'version'], capture_output=True, timeout=60,
+                                     text=True).stdout.strip() or version
+        except (OSError, subprocess.SubprocessError):
+            pass
+    with cacheLock:
+        identities[executable] = version
+    return version
+
+
+# cache key of a stage, None if the stage is not cached
+def cacheKey(tool, inputs):
+    if variables["cachedir"] == "" or tool not in cacheTools:
+        return None
+    if tool in variables["force"]:
+        return None
+    executable, databases = cacheTools[tool]
+    if executable == "megantools":
+        version = toolVersion(variables["megantools"] + "/daa2rma")
+    else:
+        version = toolVersion(variables[executable])
+    try:
+        content = [contentHash(i) for i in inputs]
+    except OSError:
+        return None
+    params = dict((p, str(variables[p])) for p in stageParams[tool] if p != executable and p not in databases)
+    with cacheLock:
+        for d in databases:
+            if d not in identities:
+                identities[d] = fileIdentity(variables[d])
+        dbs = dict((d, identities[d]) for d in databases)
+    key = json.dumps({"tool": tool, "version": version, "databases": dbs, "params": params, "inputs": content},
+                     sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# hardlink a file, copy it if that is not possible (e.g. another file system)
+def linkFile(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+# put the cached outputs of a stage into place, False if they are not in the cache
+def fetchCache(cachekey, outputs):
+    entry = variables["cachedir"] + "/" + cachekey
+    if not os.path.exists(entry + "/entry.json"):
+        return False
+    with open(entry + "/entry.json", 'r') as e:
+        meta = json.load(e)
+    if len(meta["outputs"]) != len(outputs):
+        return False
+    for i, o in enumerate(outputs):
+        if os.path.dirname(o) != "":
+            os.makedirs(os.path.dirname(o), exist_ok=True)
+        linkFile(entry + "/" + str(i), o)
+    # the modification time of the entry is its last use
+    os.utime(entry + "/entry.json")
+    return True
+
+
+# store the outputs of a stage in the cache. The entry is built in a temporary directory and renamed, so other runs
+# never see an incomplete entry.
+def storeCache(cachekey, tool, stage, outputs):
+    entry = variables["cachedir"] + "/" + cachekey
+    if os.path.exists(entry):
+        return
+    tmp = variables["cachedir"] + "/tmp." + cachekey + "." + str(os.getpid()) + "." + str(threading.get_ident())
+    try:
+        os.makedirs(tmp)
+        for i, o in enumerate(outputs):
+            linkFile(o, tmp + "/" + str(i))
+        with open(tmp + "/entry.json", 'w') as e:
+            json.dump({"tool": tool, "stage": stage, "outputs": [os.path.basename(o) for o in outputs],
+                       "created": str(datetime.now())}, e)
+        os.rename(tmp, entry)
+    except OSError as e:
+        logging.warning("Could not store " + stage + " in the cache: " + str(e) + "\n")
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    if variables["cachesize"] > 0:
+        pruneCache(variables["cachedir"], variables["cachesize"])
+
+
+# entries of the cache: key, metadata, size in bytes and time of the last use, most recently used first
+def cacheEntries(cachedir):
+    entries = list()
+    for key in os.listdir(cachedir):
+        path = cachedir + "/" + key
+        if not os.path.exists(path + "/entry.json"):
+            continue
+        with open(path + "/entry.json", 'r') as e:
+            meta = json.load(e)
+        size = sum(os.path.getsize(path + "/" + f) for f in os.listdir(path))
+        entries.append((key, meta, size, os.path.getmtime(path + "/entry.json")))
+    entries.sort(key=lambda e: -e[3])
+    return entries
+
+
+# remove the least recently used entries until the cache is not larger than size GB, and left over temporary entries
+def pruneCache(cachedir, size):
+    with cacheLock:
+        removed = 0
+        for key in os.listdir(cachedir):
+            if key.startswith("tmp.") and time.time() - os.path.getmtime(cachedir + "/" + key) > 86400:
+                shutil.rmtree(cachedir + "/" + key, ignore_errors=True)
+        total = 0
+        for key, meta, bytes, used in cacheEntries(cachedir):
+            total += bytes
+            if total > size * (1 << 30):
+                shutil.rmtree(cachedir + "/" + key, ignore_errors=True)
+                removed += 1
+        return removed
+
+
+# command line interface to inspect and prune the cache
+def cacheCommand(argv):
+    parser = argparse.ArgumentParser(prog="Maple.py cache", description="Inspect and prune the MAPle result cache")
+    parser.add_argument("cachedir", type=str, help='''Cache directory (cachedir in the config)''')
+    parser.add_argument("action", type=str, choices=["list", "prune", "clear"],
+                        help='''list the entries, prune them to --size or clear the whole cache''')
+    parser.add_argument("--size", type=float, default=None, help='''Size limit in GB for prune''')
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.cachedir):
+        sys.stderr.write("[FATAL ERROR] " + args.cachedir + " is no cache directory\n")
+        sys.exit(1)
+    if args.action == "list":
+        entries = cacheEntries(args.cachedir)
+        for key, meta, size, used in entries:
+            print("%s %-10s %10.1f MB  %s  %s" % (key[:16], meta["tool"], size / 1048576.0,
+                                                   datetime.fromtimestamp(used).strftime("%Y-%m-%d %H:%M"),
+                                                   meta["stage"]))
+        print("%d entries, %.1f MB" % (len(entries), sum(e[2] for e in entries) / 1048576.0))
+    elif args.action == "prune":
+        if args.size is None:
+            parser.error("prune needs --size")
+        print("Removed %d entries" % pruneCache(args.cachedir, args.size))
+    else:
+        print("Removed %d entries" % pruneCache(args.cachedir, 0))
+
+
+# command line interface to the QC store: the runs, the QC values of the samples of a run, the FastQC modules of a
+# sample
+def qcCommand(argv):
+    parser = argparse.ArgumentParser(prog="Maple.py qc", description="Query the MAPle QC store")
+    parser.add_argument("store", type=str, help='''QC store (qcstore in the config, e.g. <outdirectory>/qc.sqlite)''')
+    parser.add_argument("action", type=str, choices=["runs", "samples", "fastqc"],
+                        help='''list the runs, the read statistics of the samples of a run or the FastQC modules of
+                        --sample''')
+    parser.add_argument("--run", type=str, default=None, help='''Run (default: the latest one)''')
+    parser.add_argument("--sample", type=str, default=None, help='''Sample for fastqc''')
+    parser.add_argument("--module", type=str, default=None, help='''Print the table of this FastQC module''')
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.store):
+        sys.stderr.write("[FATAL ERROR] " + args.store + " is no QC store\n")
+        sys.exit(1)
+    with closing(qcConnect(args.store)) as db:
+        if args.action == "runs":
+            for run, outdir, started, host, samples in db.execute(
+                    "SELECT runs.run, outdir, started, host, COUNT(DISTINCT sample) FROM runs LEFT JOIN readstats "
+                    "ON runs.run = readstats.run GROUP BY runs.run ORDER BY runs.run"):
+                print("%s %5d samples  %s  %s  %s" % (run, samples, started[:16], host, outdir))
+            return
+        run = args.run or (db.execute("SELECT MAX(run) FROM runs").fetchone()[0])
+        if args.action == "samples":
+            print("%-24s %10s %10s %8s %8s %8s %10s %10s %7s" % ("sample", "raw", "trimmed", "loss", "rawqual",
+                                                                "trimqual", "filtered", "host", "fastqc"))
+            for row in db.execute(
+                    "SELECT sample, "
+                    "MAX(CASE WHEN step = 'raw' AND mate = 2 THEN reads END), "
+                    "MAX(CASE WHEN step = 'trimmed' AND mate = 2 THEN reads END), "
+                    "AVG(CASE WHEN step = 'raw' THEN meanqual END), "
+                    "AVG(CASE WHEN step = 'trimmed' THEN meanqual END), "
+                    "MAX(CASE WHEN step = 'filtered' AND mate = 2 THEN reads END), "
+                    "MAX(CASE WHEN step = 'host' AND mate = 2 THEN reads END), "
+                    "(SELECT COUNT(*) FROM fastqc f WHERE f.run = r.run AND f.sample = r.sample AND status = 'fail') "
+                    "FROM readstats r WHERE run = ? GROUP BY sample ORDER BY sample", (run,)):
+                loss = 1.0 - float(row[2]) / row[1] if row[1] and row[2] is not None else None
+                values = [row[1], row[2], loss, row[3], row[4], row[5], row[6]]
+                print("%-24s %10s %10s %8s %8s %8s %10s %10s %7d" % tuple(
+                    [row[0]] + ["-" if v is None else str(round(v, 3)) for v in values] + [row[7]]))
+            return
+        if args.sample is None:
+            parser.error("fastqc needs --sample")
+        if args.module is None:
+            for step, mate, module, status in db.execute(
+                    "SELECT step, mate, module, status FROM fastqc WHERE run = ? AND sample = ? "
+                    "ORDER BY step, module, mate", (run, args.sample)):
+                print("%-8s R%d %-6s %s" % (step, mate, status, module))
+            return
+        for step, mate, data in db.execute(
+                "SELECT step, mate, data FROM fastqcrows WHERE run = ? AND sample = ? AND module = ? "
+                "ORDER BY step, mate, row", (run, args.sample, args.module)):
+            print(step + "\tR" + str(mate) + "\t" + "\t".join(k + "=" + v for k, v in json.loads(data).items()))
+
+
+# zip report FastQC writes for a read file
+def fastqcReport(path):
+    name = os.path.basename(path)
+    for ext in (".gz", ".bz2", ".fastq", ".fq", ".fasta", ".fa"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return os.path.dirname(path) + "/fastqc/" + name + "_fastqc.zip"
+
+
+# ioctl cloning a file on copy-on-write file systems (btrfs, XFS), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+# put a raw read file into 00_RAW without copying its data if possible
+def stageFile(infile, outfile):
+    if os.path.lexists(outfile):
+        os.remove(outfile)
+    if not variables["keepraw"]:
+        try:
+            os.rename(infile, outfile)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # different file system, copy and remove
+            shutil.move(infile, outfile)
+        return "moved"
+    mode = variables["staging"]
+    if mode in ("auto", "reflink"):
+        try:
+            with open(infile, 'rb') as src, open(outfile, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return "reflink"
+        except OSError:
+            os.remove(outfile)
+            if mode == "reflink":
+                raise
+    if mode in ("auto", "hardlink"):
+        try:
+            os.link(infile, outfile)
+            return "hardlink"
+        except OSError:
+            if mode == "hardlink":
+                raise
+    if mode in ("auto", "symlink"):
+        os.symlink(os.path.abspath(infile), outfile)
+        return "symlink"
+    # explicit full copy (uses sendfile on Linux, no data passes through Python)
+    shutil.copyfile(infile, outfile)
+    return "copy"
+
+
+# stage all raw read files at the same time
+def stageFiles(files):
+    if len(files) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=min(8, len(files))) as pool:
+        modes = Counter(pool.map(lambda f: stageFile(f[0], f[1]), files))
+    logging.info("Staged " + str(len(files)) + " raw files (" +
+                 ", ".join(str(n) + " " + m for m, n in sorted(modes.items())) + ")\n")
+
+
+# all files of a sample, given the names of its two raw read files
+def sampleEntry(s, name1, name2):
+    p1 = variables["pairID1"]
+    p2 = variables["pairID2"]
+    gz = ".gz" if variables["compress"] else ""
+    entry = dict()
+    entry["input"] = [name1, name2]
+    entry["raw"] = ["00_RAW/" + name1, "00_RAW/" + name2]
+    entry["fastqc"] = [fastqcReport(f) for f in entry["raw"]]
+    entry["trimmed"] = ["01_trimmed/" + s + ".trimmed" + p1 + "fastq" + gz,
+                        "01_trimmed/" + s + ".trimmed" + p2 + "fastq" + gz]
+    entry["fastqcTrimmed"] = [fastqcReport(f) for f in entry["trimmed"]]
+    entry["dedup"] = ["01_dedup/" + s + ".dedup" + p1 + "fastq" + gz, "01_dedup/" + s + ".dedup" + p2 + "fastq" + gz]
+    # Basic Metagenomics
+    if variables["diamondpaired"]:
+        entry["basicDaa"] = ["02_basic_aligned/" + s + ".daa"]
+    else:
+        entry["basicDaa"] = ["02_basic_aligned/" + s + p1 + "daa", "02_basic_aligned/" + s + p2 + "daa"]
+    entry["basicRma"] = "03_basic_megan/" + s + ".rma6"
+    # Host-Associated Data
+    entry["hostRma"] = ["02_host_filtered/" + s + ".temp" + p1 + "rma", "02_host_filtered/" + s + ".temp" + p2 + "rma"]
+    entry["filtered"] = ["02_host_filtered/" + s + ".filtered" + p1 + "fasta" + gz,
+                         "02_host_filtered/" + s + ".filtered" + p2 + "fasta" + gz]
+    entry["host"] = ["02_host_filtered/" + s + ".host" + p1 + "fasta" + gz,
+                     "02_host_filtered/" + s + ".host" + p2 + "fasta" + gz]
+    entry["filteredQuery"] = entry["filtered"]
+    if variables["diamondpaired"]:
+        entry["hostDaa"] = ["03_host_aligned/" + s + ".daa"]
+    else:
+        entry["hostDaa"] = ["03_host_aligned/" + s + p1 + "daa", "03_host_aligned/" + s + p2 + "daa"]
+    entry["hostMegan"] = "04_host_megan/" + s + ".rma6"
+    # Taxonomic Analysis
+    entry["selected16S"] = "02_16S_selected/" + s
+    entry["extraction16S"] = "02_16S_selected/" + s + ".extraction.fasta" + gz
+    entry["rma16S"] = "03_16S_aligned/" + s + ".rma"
+    entry["taxonomy16S"] = "02_16S_selected/" + s + ".taxonomy.txt"
+    # Abundances
+    entry["counts"] = {source: "05_abundance/" + s + "." + source + ".tsv" for source in abundanceSources}
+    return entry
+
+
+# split the name of a raw read file into sample name and mate (0 or 1), None if it is no read file
+def parseReadFile(i):
+    if not ((i.endswith("fastq.gz")) or (i.endswith("fq.gz"))) or i.startswith("_"):
+        return None
+    if re.search(variables["pairID1pattern"], i):
+        return re.split(variables["pairID1pattern"], i)[0], 0
+    if re.search(variables["pairID2pattern"], i):
+        return re.split(variables["pairID2pattern"], i)[0], 1
+    logging.error("Read pair identifiers cannot be detected.")
+    raise ValueError("Read pair identifiers cannot be detected in " + i + ".")
+
+
+# read the sample manifest of an earlier run of this output directory
+def loadManifest():
+    manifest.clear()
+    if os.path.exists(variables["manifest"]):
+        with open(variables["manifest"], 'r') as m:
+            manifest.update(json.load(m))
+
+
+# write the sample manifest
+def saveManifest():
+    with open(variables["manifest"] + ".tmp", 'w') as m:
+        json.dump(manifest, m, indent=1, sort_keys=True)
+    os.replace(variables["manifest"] + ".tmp", variables["manifest"])
+
+
+# main log of the run, the lines of all samples
+def mainLog(logname):
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(logname, 'w', 'utf-8')
+    formatter = logging.Formatter('%(name)s [%(sample)s] %(message)s')
+    handler.setFormatter(formatter)  # Pass handler as a parameter, not assign
+    handler.addFilter(SampleFilter())
+    root_logger.addHandler(handler)
+
+
+# read files in the input directory by sample: [R1, R2], None for a missing mate
+def scanInput(indir):
+    pairs = dict()
+    for i in os.listdir(indir):
+        parsed = parseReadFile(i)
+        if parsed is None:
+            continue
+        if parsed[0] not in pairs:
+            pairs[parsed[0]] = [None, None]
+        pairs[parsed[0]][parsed[1]] = i
+        # else:
+        #    raise ValueError("No valid compressed FastA files could be detected.")
+    return pairs
+
+
+# add samples to the manifest and stage their raw files
+def registerSamples(indir, pairs):
+    staging = list()
+    for sample in sorted(pairs):
+        manifest[sample] = sampleEntry(sample, pairs[sample][0], pairs[sample][1])
+        for i in pairs[sample]:
+            infile = indir + "/" + i
+            outfile = "00_RAW/" + i
+            if os.path.exists(outfile) and os.path.getsize(outfile) == os.path.getsize(infile):
+                # staged by an earlier run of this output directory
+                continue
+            staging.append((infile, outfile))
+    stageFiles(staging)
+    saveManifest()
+
+
 # moving and subsequently renaming the raw files
-def setupFiles(indir, outdir):
+def setupFiles(indir, outdir, watch=False):
     print("Setting up input"),
     if not os.path.exists(outdir):
         os.makedirs(outdir)
     #global loghandle
     logname = outdir + "/" + variables["name"] + ".log"
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.DEBUG)
-    handler = logging.FileHandler(logname, 'w', 'utf-8')
-    formatter = logging.Formatter('%(name)s %(message)s')
-    handler.setFormatter(formatter)  # Pass handler as a parameter, not assign
-    root_logger.addHandler(handler)
+    mainLog(logname)
     #logging.basicConfig(filename=logname, encoding='utf-8', level=logging.DEBUG)
     #loghandle = open(outdir + "/" + variables["name"] + ".log", 'w')
     logging.info(str(datetime.now()) + ": Started Setup\n")
     #loghandle.write(str(datetime.now()) + ": Started Setup\n")
-    samples = list()
+    indir = os.path.abspath(indir)
     os.chdir(outdir)
     if not os.path.exists(indir):
         sys.stderr.write(
@@ -126,32 +1332,24 @@ def setupFiles(indir, outdir):
         sys.exit(1)
     rawdir = "00_RAW"
     if not os.path.exists(os.getcwd() + "/" + rawdir):
-        os.makedirs(os.getcwd() + "/" + rawdir)
+        os.makedirs(os.getcwd() + "/" + rawdir, exist_ok=True)
     print("."),
-    for i in os.listdir(indir):
-        if (i.endswith("fastq.gz")) or (i.endswith("fq.gz")):
-            if not (i.startswith("\_")):
-                infile = indir + "/" + i
-                if re.search(variables["pairID1pattern"], i):
-                    sample = re.split(variables["pairID1pattern"], i)[0]
-                else:
-                    if re.search(variables["pairID2pattern"], i):
-                        sample = re.split(variables["pairID2pattern"], i)[0]
-                    else:
-                        raise ValueError("Read pair identifiers cannot be detected.")
-                        logging.error("Read pair identifiers cannot be detected.")
-                if not (sample in samples):
-                    samples.append(sample)
-
-                outfile = "00_RAW/" + i
-                if variables["keepraw"]:
-                    command = subprocess.Popen(['cp', infile, outfile])
-                else:
-                    command = subprocess.Popen(['mv', infile, outfile])
-                command.wait()
-
-        # else:
-        #    raise ValueError("No valid compressed FastA files could be detected.")
+    # the input directory is scanned exactly once, samples staged by an earlier run are already in the manifest
+    loadManifest()
+    for sample in list(manifest):
+        # paths are derived again in case the layout of the output directory changed since
+        manifest[sample] = sampleEntry(sample, manifest[sample]["input"][0], manifest[sample]["input"][1])
+    if watch:
+        # the samples are registered by watchInput as they arrive
+        saveManifest()
+        return sorted(manifest)
+    pairs = scanInput(indir)
+    for sample in sorted(pairs):
+        if None in pairs[sample]:
+            logging.error("Sample " + sample + " does not have both mates in the input directory, skipping it\n")
+            del pairs[sample]
+    registerSamples(indir, pairs)
+    samples = sorted(manifest)
     print("."),
     logging.info(str(datetime.now()) + ": Finished Setup successfully\n")
     #loghandle.write(str(datetime.now()) + ": Finished Setup successfully\n")
@@ -159,56 +1357,104 @@ def setupFiles(indir, outdir):
     return samples
 
 
-# run FastQC on a given sample, either in paired or in single mode
-def fastqc(samplename, indir, mode):
-    file1 = ""
-    file2 = ""
+# Preview mode: share of the reads of every sample that was sampled, the raw QC breakpoint is scaled by it
+previewScale = dict()
+
+
+# sample read pairs of a sample in a single pass, both mates stay in sync. With size >= 1 size pairs are drawn by
+# reservoir sampling, with size < 1 every pair is kept with that probability. Returns the number of pairs read and kept.
+def subsamplePair(files, outfiles, size, seed):
+    rng = random.Random(seed)
+    reservoir = list()
+    total = 0
+    mismatch = 0
+    with BgzfWriter(outfiles[0]) as out1, BgzfWriter(outfiles[1]) as out2:
+        for r1, r2 in zip(readRecords(files[0]), readRecords(files[1])):
+            if tagMate(r1[0], b"") != tagMate(r2[0], b""):
+                mismatch += 1
+            pair = (b"\n".join([r1[0]] + r1[1]) + b"\n", b"\n".join([r2[0]] + r2[1]) + b"\n")
+            total += 1
+            if size < 1:
+                if rng.random() < size:
+                    out1.write(pair[0])
+                    out2.write(pair[1])
+                    reservoir.append(None)
+            elif len(reservoir) < size:
+                reservoir.append(pair)
+            else:
+                k = rng.randrange(total)
+                if k < size:
+                    reservoir[k] = pair
+        if size >= 1:
+            for pair in reservoir:
+                out1.write(pair[0])
+                out2.write(pair[1])
+    return total, len(reservoir), mismatch
+
+
+# write a subsample of every sample in indir to previewdir/input (same file names), returns that directory
+def previewInput(indir, previewdir, size, seed):
+    print("Sampling reads for the preview"),
+    previewin = os.path.abspath(previewdir) + "/input"
+    if not os.path.exists(previewin):
+        os.makedirs(previewin)
+    pairs = dict()
+    for i in os.listdir(indir):
+        parsed = parseReadFile(i)
+        if parsed is not None:
+            pairs.setdefault(parsed[0], [None, None])[parsed[1]] = i
+    pairs = dict((sample, files) for sample, files in pairs.items() if None not in files)
+
+    def sample(name):
+        files = pairs[name]
+        return name, subsamplePair([indir + "/" + f for f in files], [previewin + "/" + f for f in files],
+                                   size, seed)
+
+    previewScale.clear()
+    messages = list()
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(pairs)))) as pool:
+        for name, (total, kept, mismatch) in pool.map(sample, sorted(pairs)):
+            previewScale[name] = float(kept) / total if total > 0 else 1.0
+            messages.append("Preview of sample " + name + ": " + str(kept) + " of " + str(total) + " read pairs\n")
+            if mismatch > 0:
+                messages.append("Preview of sample " + name + ": the read names of " + str(mismatch) +
+                                " pairs differ between the mates, check pairID1 and pairID2\n")
+            print("."),
+    print(".")
+    return previewin, messages
+
+
+# run FastQC on the read files of a sample (both mates or a single file)
+def fastqc(samplename, files, fastqcdir):
     logging.info(str(datetime.now()) + ": Started QC\n")
     #loghandle.write(str(datetime.now()) + ": Started QC\n")
-    if not os.path.exists(os.getcwd() + "/" + indir):
-        sys.stderr.write(
-            "[FATAL ERROR] The directory on which you are running FastQC does not seem to exist. Please check file permissions and disk space.")
-        logging.error("[FATAL ERROR] The directory on which you are running FastQC does not seem to exist. Please check file permissions and disk space.")
-        sys.exit(1)
-    fastqcdir = indir + "/fastqc"
+    for f in files:
+        if not os.path.exists(f):
+            # the stage fails, the other stages of the sample go on (sys.exit would end the scheduler of the sample)
+            raise IOError("The file " + f + " on which you are running FastQC does not seem to exist. Please check "
+                          "file permissions and disk space.")
     if not os.path.exists(os.getcwd() + "/" + fastqcdir):
-        os.makedirs(os.getcwd() + "/" + fastqcdir)
-    if mode == "paired":
+        os.makedirs(os.getcwd() + "/" + fastqcdir, exist_ok=True)
+    if len(files) == 2:
         logging.info("Entering paired filter mode\n")
         #loghandle.write("Entering paired filter mode\n")
-        for i in os.listdir(indir):
-            if i.startswith(samplename + variables["pairID1"]):
-                file1 = indir + "/" + i
-            if i.startswith(samplename + variables["pairID2"]):
-                file2 = indir + "/" + i
-        command = subprocess.Popen([variables["FASTQC"], '-noextract', '-o', fastqcdir, file1, file2])
-    else:
-        for i in os.listdir(indir):
-            if i.startswith(samplename):
-                file1 = indir + "/" + i
-        command = subprocess.Popen([variables["FASTQC"], '-noextract', '-o', fastqcdir, file1])
-    command.wait()
+    runCommand([variables["FASTQC"], '-noextract', '-o', fastqcdir] + files)
     logging.info(str(datetime.now()) + ": Finished QC successfully\n")
     #loghandle.write(str(datetime.now()) + ": Finished QC successfully\n")
 
 
 # Trimming paired reads with prinseq++
-def trim(samplename, trimdir, rawdir):
+def trim(samplename, raw, trimmed):
     logging.info(str(datetime.now()) + ": Started trimming\n")
     #loghandle.write(str(datetime.now()) + ": Started trimming\n")
+    trimdir = os.path.dirname(trimmed[0])
     if not os.path.exists(os.getcwd() + "/" + trimdir):
-        os.makedirs(os.getcwd() + "/" + trimdir)
+        os.makedirs(os.getcwd() + "/" + trimdir, exist_ok=True)
     # tempdir = trimdir + "/temp"
     # if not os.path.exists(os.getcwd() + "/" + tempdir):
     #     os.makedirs(os.getcwd() + "/" + tempdir)
-    thedir = os.getcwd() + "/" + rawdir
-    for i in os.listdir(thedir):
-        temp = thedir + "/" + i
-        if os.path.isfile(temp):
-            if i.startswith(samplename + variables["pairID1"]):
-                file1 = temp
-            if i.startswith(samplename + variables["pairID2"]):
-                file2 = temp
+    file1 = raw[0]
+    file2 = raw[1]
     # if variables["compressed"]:
     #     # outfile1 = open(tempdir + "/" + samplename + ".fastq", 'w')
     #     # command = subprocess.Popen([variables["gzip"], '-dc', file1], stdout=subprocess.PIPE)
@@ -253,15 +1499,16 @@ def trim(samplename, trimdir, rawdir):
     #                             str(variables["minlength"]),
     #                             '-out_good', trimdir + "/" + samplename + ".trim.good",
     #                             '-out_bad', trimdir + "/" + samplename + ".trim.bad"])
-    outname1 = trimdir + "/" + samplename + ".trimmed" + variables["pairID1"] + "fastq"
-    outname2 = trimdir + "/" + samplename + ".trimmed" + variables["pairID2"] + "fastq"
+    def prinseq(outname1, outname2):
+        runCommand([variables["prinseq"], '-fastq', file1, '-fastq2', file2, '-threads', str(toolThreads()),
+                    '-trim_qual_window', str(variables["trimwindow"]), '-trim_qual_right',
+                    str(variables["trimqual"]), '-trim_left', str(variables["lefttrim"]), '-min_len',
+                    str(variables["minlength"]), '-out_good', outname1, '-out_good2', outname2])
 
-    command = subprocess.Popen([variables["prinseq"], '-fastq', file1, '-fastq2', file2, '-threads', '30',
-                               '-trim_qual_window', str(variables["trimwindow"]), '-trim_qual_right',
-                               str(variables["trimqual"]), '-trim_left', str(variables["lefttrim"]), '-min_len',
-                               str(variables["minlength"]), '-out_good', outname1, '-out_good2', outname2])
-
-    command.wait()
+    if trimmed[0].endswith(".gz"):
+        compressedOutputs(trimmed, lambda pipes: prinseq(pipes[0], pipes[1]))
+    else:
+        prinseq(trimmed[0], trimmed[1])
 
      # shutil.rmtree(os.getcwd() + "/" + tempdir)
     logging.info(str(datetime.now()) + ": Finished trimming successfully\n")
@@ -269,271 +1516,1720 @@ def trim(samplename, trimdir, rawdir):
 
 
 # Filtering out contaminants or host sequences with MALT
-def filterHost(samplename, filtereddir, trimmeddir):
+def filterHost(samplename, reads, rmas, filtered, hosts, batch=True):
     logging.info(str(datetime.now()) + ": Started filtering host reads\n")
     #loghandle.write(str(datetime.now()) + ": Started filtering host reads\n")
+    filtereddir = os.path.dirname(filtered[0])
     if not os.path.exists(os.getcwd() + "/" + filtereddir):
-        os.makedirs(os.getcwd() + "/" + filtereddir)
-        c = subprocess.Popen(['chmod', '-R', '777', os.getcwd() + "/" + filtereddir])
-        c.wait()
-    infile = trimmeddir + "/" + samplename + ".trimmed" + variables["pairID1"] + "fastq"
-    rmafile = filtereddir + "/" + samplename + ".temp" + variables["pairID1"] + "rma"
-    outfile = filtereddir + "/" + samplename + ".filtered" + variables["pairID1"] + "fasta"
-    hostfile = filtereddir + "/" + samplename + ".host" + variables["pairID1"] + "fasta"
-    command = subprocess.Popen(
-        [variables["malt"], '-v', '-m', 'BlastN', '-at', 'SemiGlobal', '-t', '30', '-mem', "page",
-         '-id', '75.00', '-supp', str(variables["minsupp"]), '-e', str(variables["maxeval"]),
-         '-i', infile, '-d', variables["hostDB"], '-o', rmafile, '-ou', outfile, '-oa', hostfile])
-    command.wait()
-    infile = trimmeddir + "/" + samplename + ".trimmed" + variables["pairID2"] + "fastq"
-    rmafile = filtereddir + "/" + samplename + ".temp" + variables["pairID2"] + "rma"
-    outfile = filtereddir + "/" + samplename + ".filtered" + variables["pairID2"] + "fasta"
-    hostfile = filtereddir + "/" + samplename + ".host" + variables["pairID2"] + "fasta"
-    command = subprocess.Popen([variables["malt"], '-m', 'BlastN', '-at', 'SemiGlobal', '-t', '30', '-mem', "page",
-                                '-id', '75.00', '-supp', str(variables["minsupp"]), '-e', str(variables["maxeval"]),
-                                '-i', infile, '-d', variables["hostDB"], '-o', rmafile, '-ou', outfile,
-                                '-oa', hostfile])
-    command.wait()
+        os.makedirs(os.getcwd() + "/" + filtereddir, exist_ok=True)
+        os.chmod(os.getcwd() + "/" + filtereddir, 0o777)
+    options = ['-v', '-m', 'BlastN', '-at', 'SemiGlobal'] + maltMemory(variables["hostDB"]) + ['-id', '75.00',
+               '-supp', str(variables["minsupp"]), '-e', str(variables["maxeval"]), '-d', variables["hostDB"]]
+    if variables["dedup"]:
+        options += ['-mag']
+
+    def align(unaligned, aligned):
+        jobs = list()
+        for infile, rmafile, outfile, hostfile in zip(reads, rmas, unaligned, aligned):
+            jobs.append({"input": infile, "rma": rmafile, "unaligned": outfile, "aligned": hostfile})
+        if not batch:
+            # streamed reads (named pipes) can not wait for other samples
+            for job in jobs:
+                maltBatcher.execute(options, [job])
+        elif variables["maltbatch"] <= 1:
+            # one malt-run per mate, as without batching
+            for job in jobs:
+                maltBatcher.run(options, [job])
+        else:
+            maltBatcher.run(options, jobs)
+
+    if filtered[0].endswith(".gz"):
+        # MALT writes the reads uncompressed into named pipes, they are compressed on the way to disk
+        options += ['-z', 'false']
+        compressedOutputs(filtered + hosts, lambda pipes: align(pipes[:len(filtered)], pipes[len(filtered):]))
+    else:
+        align(filtered, hosts)
     logging.info(str(datetime.now()) + ": Finished filtering host reads successfully\n")
     #loghandle.write(str(datetime.now()) + ": Finished filtering host reads successfully\n")
 
 
+# BGZF: gzip files made of independent members ("blocks") of at most bgzfBlock bytes of data, each with its compressed
+# size in the extra field of its header (as written by samtools/htslib). Any gzip reader reads them; the blocks can be
+# compressed and decompressed in parallel.
+bgzfBlock = 0xff00
+bgzfEOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+# compress one BGZF block
+def bgzfCompress(data, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = c.compress(data) + c.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(deflated) + 25)
+    return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+# decompress one BGZF block
+def bgzfDecompress(block):
+    data = zlib.decompress(block[18:-8], -15)
+    if zlib.crc32(data) != struct.unpack('<I', block[-8:-4])[0]:
+        raise IOError("Corrupt BGZF block")
+    return data
+
+
+# does the file start with a BGZF block
+def isBgzf(data):
+    return len(data) >= 18 and data[:4] == b"\x1f\x8b\x08\x04" and data[10:14] == b"\x06\x00BC"
+
+
+# the compressed blocks of a BGZF file, from the current position
+def bgzfBlocks(f):
+    header = f.read(18)
+    while len(header) == 18:
+        block = header + f.read(struct.unpack('<H', header[16:18])[0] + 1 - 18)
+        yield block
+        header = f.read(18)
+
+
+# data of an open BGZF file, from the current position, decompressed block by block by several threads
+def bgzfRead(f, threads):
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for block in bgzfBlocks(f):
+            pending.append(pool.submit(bgzfDecompress, block))
+            if len(pending) > 4 * threads:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+# file object writing BGZF, the blocks are compressed by several threads and written in order
+class BgzfWriter:
+    def __init__(self, path, threads=None, level=None):
+        self.threads = threads or toolThreads()
+        self.level = variables["compresslevel"] if level is None else level
+        self.file = open(path, 'wb')
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= bgzfBlock:
+            self.submit(bytes(self.buffer[:bgzfBlock]))
+            del self.buffer[:bgzfBlock]
+
+    def submit(self, data):
+        self.pending.append(self.pool.submit(bgzfCompress, data, self.level))
+        while len(self.pending) > 4 * self.threads:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        try:
+            if len(self.buffer) > 0:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while len(self.pending) > 0:
+                self.file.write(self.pending.popleft().result())
+            self.file.write(bgzfEOF)
+        finally:
+            self.pool.shutdown()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# name of an intermediate without the .gz of its compressed form
+def plainName(path):
+    return path[:-3] if path.endswith(".gz") else path
+
+
+# open an intermediate for writing, compressed if its name ends with .gz
+def outputFile(path):
+    if path.endswith(".gz"):
+        return BgzfWriter(path)
+    return open(path, 'wb')
+
+
+# compress a file written by a tool into an intermediate and remove the uncompressed file
+def compressFile(path, compressed):
+    with open(path, 'rb') as f, BgzfWriter(compressed) as out:
+        data = f.read(streamBlock)
+        while len(data) > 0:
+            out.write(data)
+            data = f.read(streamBlock)
+    os.remove(path)
+
+
+# run fn with named pipes in place of the compressed files it should write; what the tool writes into the pipes is
+# compressed into the files on the way to disk
+def compressedOutputs(outputs, fn):
+    return pipedAttempts(lambda: compressedAttempt(outputs, fn))
+
+
+def compressedAttempt(outputs, fn):
+    pipedir = os.path.dirname(outputs[0]) + "/.compress_" + str(os.getpid()) + "_" + str(threading.get_ident())
+    if os.path.exists(pipedir):
+        shutil.rmtree(pipedir)
+    os.makedirs(pipedir)
+    threads = max(1, toolThreads() // len(outputs))
+    pipes = list()
+    tees = list()
+    try:
+        for i, path in enumerate(outputs):
+            pipe = pipedir + "/" + str(i) + "_" + os.path.basename(plainName(path))
+            os.mkfifo(pipe)
+            pipes.append(pipe)
+            blocks = queue.Queue(streamQueue)
+            tees.append(threading.Thread(target=teeStream, args=(pipe, [blocks])))
+            tees.append(threading.Thread(target=teeWriter, args=(path, blocks, None, threads)))
+        for t in tees:
+            t.start()
+        return fn(pipes)
+    finally:
+        # a pipe the tool never opened (e.g. it failed) is closed by opening it for writing
+        for pipe, t in zip(pipes, tees[::2]):
+            while t.is_alive():
+                try:
+                    os.close(os.open(pipe, os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+                t.join(0.05)
+        for t in tees:
+            t.join()
+        shutil.rmtree(pipedir, ignore_errors=True)
+
+
+# records of a FASTQ or FASTA file as (name line, remaining lines), read in large blocks
+def readRecords(path):
+    rest = b""
+    fasta = None
+    for block in fastqBlocks(path):
+        lines = (rest + block).split(b"\n")
+        if fasta is None:
+            fasta = lines[0].startswith(b">")
+        if fasta:
+            # the last record of the block may continue in the next one
+            starts = [i for i, l in enumerate(lines) if l.startswith(b">")]
+            for a, b in zip(starts, starts[1:]):
+                yield lines[a], lines[a + 1:b]
+            rest = b"\n".join(lines[starts[-1]:]) if len(starts) > 0 else b"\n".join(lines)
+        else:
+            n = (len(lines) - 1) // 4 * 4
+            for i in range(0, n, 4):
+                yield lines[i], lines[i + 1:i + 4]
+            rest = b"\n".join(lines[n:])
+    lines = rest.split(b"\n")
+    while len(lines) > 0 and len(lines[-1]) == 0:
+        lines.pop()
+    if len(lines) > 0:
+        yield lines[0], lines[1:]
+
+
+# name line with the mate tag /1 or /2 (replacing an existing one), so both mates can share one query file
+def tagMate(name, mate):
+    readid = name.split(None, 1)[0]
+    if readid[-2:] in (b"/1", b"/2"):
+        readid = readid[:-2]
+    return readid + mate
+
+
+# write both mates of a sample, mate-tagged, into a file or named pipe. Each mate is read by its own thread and
+# written in batches of whole records, so the mates do not have to hold the same reads (after the host filter they
+# do not) and streamed mates are read at the same time; daa2rma pairs the reads by name.
+# Errors are stored in state, the pipe is closed in any case so its reader does not wait forever.
+def writePairedQuery(queries, path, state):
+    lock = threading.Lock()
+
+    def writeMate(out, query, mate):
+        try:
+            batch = list()
+            for r in readRecords(query):
+                batch.append(b"\n".join([tagMate(r[0], mate)] + r[1]))
+                if len(batch) >= 10000:
+                    with lock:
+                        out.write(b"\n".join(batch) + b"\n")
+                    batch = list()
+            if len(batch) > 0:
+                with lock:
+                    out.write(b"\n".join(batch) + b"\n")
+        except BrokenPipeError:
+            state["error"] = IOError("DIAMOND stopped reading the paired query " + path)
+        except Exception as e:
+            state["error"] = e
+
+    try:
+        with open(path, 'wb') as out:
+            mates = [threading.Thread(target=writeMate, args=(out, query, mate))
+                     for query, mate in zip(queries, (b"/1", b"/2"))]
+            for t in mates:
+                t.start()
+            for t in mates:
+                t.join()
+    except BrokenPipeError:
+        state["error"] = IOError("DIAMOND stopped reading the paired query " + path)
+
+
+# run DIAMOND blastx, either once per mate or on both mates at once (a single DAA file).
+# In paired mode the mates are streamed through a named pipe, nothing is written to disk.
+def diamondRun(queries, daas):
+    if len(daas) == 2:
+        for query, daa in zip(queries, daas):
+            runCommand([variables["diamond"], 'blastx', '-p', str(toolThreads()), '-d', variables["diamondindex"],
+                        '-a', daa, '-q', query] + diamondMemory())
+        return
+    for query in queries:
+        if not os.path.exists(query):
+            raise IOError("DIAMOND query " + query + " does not exist")
+    pipedAttempts(lambda: diamondPaired(queries, daas[0]))
+
+
+# one attempt of DIAMOND on both mates, written into a new named pipe
+def diamondPaired(queries, daa):
+    fifo = daa + ".query"
+    if os.path.lexists(fifo):
+        os.remove(fifo)
+    os.mkfifo(fifo)
+    state = dict()
+    writer = threading.Thread(target=writePairedQuery, args=(queries, fifo, state))
+    writer.start()
+    try:
+        runCommand([variables["diamond"], 'blastx', '-p', str(toolThreads()), '-d', variables["diamondindex"],
+                    '-a', daa, '-q', fifo] + diamondMemory())
+    finally:
+        if writer.is_alive():
+            # DIAMOND quit without (completely) reading the query, unblock the writer
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            while writer.is_alive():
+                try:
+                    os.read(fd, 1 << 20)
+                except BlockingIOError:
+                    pass
+                writer.join(0.1)
+            os.close(fd)
+        os.remove(fifo)
+    if "error" in state:
+        raise state["error"]
+
+
 # Running Diamond on non-host sequences extracted from host filtering (they are fastA)
-def diamondFasta(samplename, aligneddir, filtereddir):
+def diamondFasta(samplename, queries, daas):
     logging.info(str(datetime.now()) + ": Started alignment of non-host reads \n")
     #loghandle.write(str(datetime.now()) + ": Started alignment of non-host reads \n")
+    aligneddir = os.path.dirname(daas[0])
     if not os.path.exists(os.getcwd() + "/" + aligneddir):
-        os.makedirs(os.getcwd() + "/" + aligneddir)
-        c = subprocess.Popen(['chmod', '-R', '777', os.getcwd() + "/" + aligneddir])
-        c.wait()
-    precommand = variables["diamond"] + " blastx -p 30 -d " + variables["diamondindex"] + " -a " + aligneddir + "/" + \
-                 samplename + variables["pairID1"] + "daa -q " + filtereddir + "/" + samplename + ".filtered" + \
-                 variables["pairID1"] + \
-                 "fasta.gz"
-    command = subprocess.Popen(precommand.split())
-    command.wait()
-    precommand = variables["diamond"] + " blastx -p 30 -d " + variables["diamondindex"] + " -a " + aligneddir + "/" + \
-                 samplename + variables["pairID2"] + "daa -q " + filtereddir + "/" + samplename + ".filtered" + \
-                 variables["pairID2"] + \
-                 "fasta.gz"
-    command = subprocess.Popen(precommand.split())
-    command.wait()
+        os.makedirs(os.getcwd() + "/" + aligneddir, exist_ok=True)
+        os.chmod(os.getcwd() + "/" + aligneddir, 0o777)
+    diamondRun(queries, daas)
     logging.info(str(datetime.now()) + ": Finished alignment of non-host reads successfully\n")
     #loghandle.write(str(datetime.now()) + ": Finished alignment of non-host reads successfully\n")
 
 
 # Running Diamond on trimmed fastQ files from unfiltered sequences
-def diamond(samplename, aligneddir, trimmeddir):
+def diamond(samplename, queries, daas):
     logging.info(str(datetime.now()) + ": Started alignment of trimmed reads \n")
     #loghandle.write(str(datetime.now()) + ": Started alignment of trimmed reads \n")
+    aligneddir = os.path.dirname(daas[0])
     if not os.path.exists(os.getcwd() + "/" + aligneddir):
-        os.makedirs(os.getcwd() + "/" + aligneddir)
-        c = subprocess.Popen(['chmod', '-R', '777', os.getcwd() + "/" + aligneddir])
-        c.wait()
-    precommand = variables["diamond"] + " blastx -p 30 -d " + variables["diamondindex"] + " -a " + aligneddir + "/" + \
-                 samplename + variables["pairID1"] + "daa -q " + trimmeddir + "/" + samplename + \
-                 ".trimmed" + variables["pairID1"] + "fastq"
-    command = subprocess.Popen(precommand.split())
-    command.wait()
-    precommand = variables["diamond"] + " blastx -p 30 -d " + variables["diamondindex"] + " -a " + aligneddir + "/" + \
-                 samplename + variables["pairID2"] + "daa -q " + trimmeddir + "/" + samplename + ".trimmed" + \
-                 variables["pairID2"] + "fastq"
-    command = subprocess.Popen(precommand.split())
-    command.wait()
+        os.makedirs(os.getcwd() + "/" + aligneddir, exist_ok=True)
+        os.chmod(os.getcwd() + "/" + aligneddir, 0o777)
+    diamondRun(queries, daas)
     logging.info(str(datetime.now()) + ": Finished alignment of trimmed reads successfully\n")
     #loghandle.write(str(datetime.now()) + ": Finished alignment of trimmed reads successfully\n")
 
 
-def daa2rma(samplename, megandir, aligneddir):
+def daa2rma(samplename, daas, rma):
     logging.info(str(datetime.now()) + ": Started generating RMA file\n")
     #loghandle.write(str(datetime.now()) + ": Started generating RMA file\n")
+    megandir = os.path.dirname(rma)
     if not os.path.exists(os.getcwd() + "/" + megandir):
-        os.makedirs(os.getcwd() + "/" + megandir)
-        c = subprocess.Popen(['chmod', '-R', '777', os.getcwd() + "/" + megandir])
-        c.wait()
-    precommand = variables["megantools"] + "/daa2rma -i " + aligneddir + "/" + samplename + variables[
-        "pairID1"] + "daa " + \
-                 aligneddir + "/" + samplename + variables["pairID2"] + "daa -o " + megandir + "/" + samplename + \
-                 ".rma6 -p true -a2t " + variables["taxonomy"] + " -mdb " + variables["mdb"] + " -me " + variables[
-                     "maxeval"] + \
-                 " -supp " + variables["minsupp"]
-    command = subprocess.Popen(precommand.split())
-    command.wait()
+        os.makedirs(os.getcwd() + "/" + megandir, exist_ok=True)
+        os.chmod(os.getcwd() + "/" + megandir, 0o777)
+    command = [variables["megantools"] + "/daa2rma", '-i'] + daas + ['-o', rma, '-p', 'true']
+    if len(daas) == 1:
+        # both mates are in one file, the last two characters of the read names (/1, /2) tell them apart
+        command += ['-ps', '2']
+    if variables["dedup"]:
+        # read pairs stand for weight=N copies
+        command += ['-mag']
+    command += ['-a2t', variables["taxonomy"], '-mdb', variables["mdb"],
+                '-me', str(variables["maxeval"]), '-supp', str(variables["minsupp"])]
+    runCommand(command)
     logging.info(str(datetime.now()) + ": Finished generating RMA file successfully\n")
     #loghandle.write(str(datetime.now()) + ": Finished generating RMA file successfully\n")
 
 
 # select 16S reads
-def select16S(samplename, filterdir, trimdir):
+def select16S(samplename, reads, prefix):
     logging.info(str(datetime.now()) + ": Started selecting 16S reads\n")
     #loghandle.write(str(datetime.now()) + ": Started selecting 16S reads\n")
+    filterdir = os.path.dirname(prefix)
     if not os.path.exists(os.getcwd() + "/" + filterdir):
-        os.makedirs(os.getcwd() + "/" + filterdir)
-    precommand = variables[
-                     "metaxa"] + " -o " + filterdir + "/" + samplename + " -1 " + trimdir + "/" + samplename + ".trimmed" + \
-                 variables["pairID1"] + "fastq" + " -2 " + trimdir + "/" + samplename + ".trimmed" + \
-                 variables["pairID2"] + "fastq -f q -x T --cpu 20"
-    command = subprocess.Popen(precommand.split())
-    command.wait()
+        os.makedirs(os.getcwd() + "/" + filterdir, exist_ok=True)
+    runCommand([variables["metaxa"], '-o', prefix, '-1', reads[0], '-2', reads[1], '-f', 'q', '-x', 'T',
+                '--cpu', str(toolThreads())])
+    extraction = prefix + ".extraction.fasta"
+    if manifest[samplename]["extraction16S"] != extraction:
+        compressFile(extraction, manifest[samplename]["extraction16S"])
     logging.info(str(datetime.now()) + ": Finished selecting 16S reads successfully\n")
     #loghandle.write(str(datetime.now()) + ": Finished selecting 16S reads successfully\n")
 
 
 # Align and classify selected 16S sequences
-def malt(samplename, aligneddir, filterdir):
+def malt(samplename, infile, outfile):
     logging.info(str(datetime.now()) + ": Started alignment of 16S reads\n")
     #loghandle.write(str(datetime.now()) + ": Started alignment of 16S reads\n")
+    aligneddir = os.path.dirname(outfile)
     if not os.path.exists(os.getcwd() + "/" + aligneddir):
-        os.makedirs(os.getcwd() + "/" + aligneddir)
-
-    infile = filterdir + "/" + samplename + ".extraction.fasta"
-    outfile = aligneddir + "/" + samplename + ".rma"
-    command = subprocess.Popen([variables["malt"], '-m', 'BlastN', '-at', 'SemiGlobal', '-t', '20', '-rqc', 'true',
-                                '-supp', str(variables["maltsupp"]), '-e', str(variables["malteval"]), '-mpi', '-top',
-                                str(75.0), str(10.0), '-i', infile, '-d', variables["maltbase"], '-o', outfile])
-    command.wait()
+        os.makedirs(os.getcwd() + "/" + aligneddir, exist_ok=True)
+
+    options = ['-m', 'BlastN', '-at', 'SemiGlobal'] + maltMemory(variables["maltbase"]) + \
+              ['-rqc', 'true', '-supp', str(variables["maltsupp"]),
+               '-e', str(variables["malteval"]), '-mpi', '-top', str(75.0), str(10.0), '-d', variables["maltbase"]]
+    if variables["dedup"]:
+        options += ['-mag']
+    maltBatcher.run(options, [{"input": infile, "rma": outfile}])
     logging.info(str(datetime.now()) + ": Finished alignment of 16S reads successfully\n")
     #loghandle.write(str(datetime.now()) + ": Finished alignment of 16S reads successfully\n")
 
 
-# read in Quality Control results for breakpoints
-def readQC(samplename, indi, mode):
-    indir = os.getcwd() + "/" + indi
-    pair = True
-    file1 = ""
-    file2 = ""
-    # set pair according to mode and "paired"/not
-    # modes are raw, trimmed, filtered (filtered is always not a paired mode)
-    if mode == "filtered":
-        pair = False
+# write the taxon counts of a sample: taxon and count per line
+def writeCounts(path, counts):
+    countdir = os.path.dirname(path)
+    if not os.path.exists(os.getcwd() + "/" + countdir):
+        os.makedirs(os.getcwd() + "/" + countdir, exist_ok=True)
+    with open(path + ".tmp", 'w') as c:
+        for taxon in sorted(counts):
+            c.write(taxon + "\t" + str(counts[taxon]) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+# read the taxon counts of a sample
+def readCounts(path):
+    counts = dict()
+    with open(path, 'r') as c:
+        for line in c:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 2 and fields[0] != "":
+                counts[fields[0]] = counts.get(fields[0], 0) + float(fields[1])
+    return counts
+
+
+# count the reads metaxa2 assigned to each taxon, collapsed reads count as often as they occurred
+def taxonomyCounts(samplename, taxonomy, counts):
+    logging.info(str(datetime.now()) + ": Started counting 16S taxa\n")
+    level = variables["abundancelevel"]
+    totals = dict()
+    with open(taxonomy, 'r') as t:
+        for line in t:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 2:
+                continue
+            taxon = fields[1]
+            if level > 0:
+                taxon = ";".join(taxon.split(";")[:level])
+            totals[taxon] = totals.get(taxon, 0) + readWeight(fields[0])
+    writeCounts(counts, totals)
+    logging.info(str(datetime.now()) + ": Finished counting 16S taxa successfully\n")
+
+
+# export the number of reads MEGAN assigned to each taxon
+def rmaCounts(samplename, rma, counts):
+    logging.info(str(datetime.now()) + ": Started exporting taxon counts of " + rma + "\n")
+    countdir = os.path.dirname(counts)
+    if not os.path.exists(os.getcwd() + "/" + countdir):
+        os.makedirs(os.getcwd() + "/" + countdir, exist_ok=True)
+    runCommand([variables["megantools"] + "/rma2info", '-i', rma, '-o', counts + ".export",
+                '-c2c', 'Taxonomy', '-n'])
+    writeCounts(counts, readCounts(counts + ".export"))
+    os.remove(counts + ".export")
+    logging.info(str(datetime.now()) + ": Finished exporting taxon counts successfully\n")
+
+
+# name line of a collapsed read pair with its number of copies. The weight goes into the read ID (DIAMOND and MALT
+# drop everything after the first space), in front of a mate tag that may be added later.
+def tagWeight(name, weight):
+    readid = name.split(None, 1)[0]
+    if readid[-2:] in (b"/1", b"/2"):
+        readid = readid[:-2]
+    return readid + b";weight=" + str(weight).encode()
+
+
+# number of copies a read stands for, from the weight dedup put into its ID
+def readWeight(readid):
+    weight = readid.rsplit(";weight=", 1)
+    if len(weight) == 2:
+        return int(weight[1].split("/")[0])
+    return 1
+
+
+# uncompressed size of a read file; for BGZF files the sizes in the block trailers are added up without
+# decompressing them
+def dataSize(path):
+    with open(path, 'rb') as f:
+        if not isBgzf(f.read(18)):
+            return os.path.getsize(path)
+        f.seek(0)
+        size = 0
+        header = f.read(18)
+        while len(header) == 18:
+            f.seek(struct.unpack('<H', header[16:18])[0] + 1 - 18 - 4, os.SEEK_CUR)
+            size += struct.unpack('<I', f.read(4))[0]
+            header = f.read(18)
+        return size
+
+
+# Collapse identical read pairs (same sequences of both mates).
+# The pairs are first spread over buckets on disk by the hash of their sequences, so identical pairs end up in the
+# same bucket. Buckets hold about dedupmemory MB of uncompressed reads, of one bucket at a time only the hash, the
+# position of the first copy and the number of copies of every pair are held in memory. The first copy is kept.
+def dedup(samplename, reads, unique):
+    logging.info(str(datetime.now()) + ": Started collapsing duplicate read pairs\n")
+    dedupdir = os.path.dirname(unique[0])
+    if not os.path.exists(os.getcwd() + "/" + dedupdir):
+        os.makedirs(os.getcwd() + "/" + dedupdir, exist_ok=True)
+    bucketdir = dedupdir + "/.buckets_" + samplename
+    if os.path.exists(bucketdir):
+        shutil.rmtree(bucketdir)
+    os.makedirs(bucketdir)
+    size = sum(dataSize(r) for r in reads)
+    nbuckets = max(1, int(size / (variables["dedupmemory"] * (1 << 20))) + 1)
+    total = 0
+    pairs = 0
+    try:
+        buckets = [open(bucketdir + "/" + str(i), 'wb') for i in range(nbuckets)]
+        try:
+            for r1, r2 in zip(readRecords(reads[0]), readRecords(reads[1])):
+                digest = hashlib.blake2b(r1[1][0] + b"\n" + r2[1][0], digest_size=16).digest()
+                # one pair per line: hash, then the lines of both records separated by NUL bytes
+                buckets[int.from_bytes(digest[:4], "little") % nbuckets].write(
+                    digest.hex().encode() + b"\0" + b"\0".join([r1[0]] + r1[1] + [r2[0]] + r2[1]) + b"\n")
+                total += 1
+        finally:
+            for b in buckets:
+                b.close()
+        with outputFile(unique[0]) as out1, outputFile(unique[1]) as out2:
+            for i in range(nbuckets):
+                # first pass: only the position of the first copy and the number of copies of every pair are held
+                # in memory, the second pass writes the first copies
+                first = dict()
+                with open(bucketdir + "/" + str(i), 'rb') as b:
+                    offset = 0
+                    for line in b:
+                        digest = line[:32]
+                        if digest in first:
+                            first[digest][1] += 1
+                        else:
+                            first[digest] = [offset, 1]
+                        offset += len(line)
+                    b.seek(0)
+                    offset = 0
+                    for line in b:
+                        position, weight = first[line[:32]]
+                        if position == offset:
+                            fields = line.rstrip(b"\n").split(b"\0")[1:]
+                            half = len(fields) // 2
+                            out1.write(b"\n".join([tagWeight(fields[0], weight)] + fields[1:half]) + b"\n")
+                            out2.write(b"\n".join([tagWeight(fields[half], weight)] + fields[half + 1:]) + b"\n")
+                        offset += len(line)
+                pairs += len(first)
+                os.remove(bucketdir + "/" + str(i))
+    finally:
+        shutil.rmtree(bucketdir, ignore_errors=True)
+    rate = 1.0 - float(pairs) / total if total > 0 else 0.0
+    logging.info("Collapsed " + str(total) + " read pairs of sample " + samplename + " into " + str(pairs) +
+                 " unique pairs (" + str(round(rate * 100, 1)) + "% duplicates)\n")
+    logging.info(str(datetime.now()) + ": Finished collapsing duplicate read pairs successfully\n")
+
+
+# read all modules of a FastQC report directly from its zip file: module name -> status, column names and rows
+def readFastqc(report):
+    modules = dict()
+    with zipfile.ZipFile(report) as z:
+        name = [n for n in z.namelist() if n.endswith("/fastqc_data.txt")][0]
+        data = z.read(name).decode("utf-8", "replace")
+    module = None
+    for line in data.splitlines():
+        if line.startswith(">>END_MODULE"):
+            module = None
+        elif line.startswith(">>"):
+            fields = line[2:].split("\t")
+            module = {"status": fields[1] if len(fields) > 1 else "", "columns": list(), "rows": list()}
+            modules[fields[0]] = module
+        elif module is None or line.startswith("##"):
+            continue
+        elif line.startswith("#"):
+            # the last comment line is the header of the table, earlier ones (e.g. the total deduplicated
+            # percentage) are values of their own
+            if len(module["columns"]) > 0:
+                module["rows"].append(dict(zip(["#" + module["columns"][0], "Value"], module["columns"][1:])))
+            module["columns"] = line[1:].split("\t")
+        elif len(line) > 0:
+            module["rows"].append(dict(zip(module["columns"], line.split("\t"))))
+    return modules
+
+
+# log the statistics of both mates for a breakpoint
+def logStats(s, step, stats):
+    logging.info(step + " QC for sample: " + s + "\n")
+    for mate, st in zip(("R1", "R2"), stats):
+        logging.info(mate + ": Minimal read length: " + str(st["minlen"]) + ", maximal read length: " +
+                     str(st["maxlen"]) + ", number of reads: " + str(st["reads"]) + ", mean quality: " +
+                     str(round(st["meanqual"], 2)) + "\n")
+
+
+# size of the blocks read from (compressed) FASTQ files by the statistics engine
+statsBlock = 4 << 20
+
+
+# read a FASTQ file, gzipped or not, in large decompressed blocks
+# concatenated gzip members (e.g. block compressed files) are decompressed one after another
+def fastqBlocks(path):
+    with open(path, 'rb') as f:
+        data = f.read(statsBlock)
+        if isBgzf(data):
+            # the blocks of BGZF files are decompressed in parallel
+            f.seek(0)
+            yield from bgzfRead(f, toolThreads())
+            return
+        if data[:2] != b"\x1f\x8b":
+            while len(data) > 0:
+                yield data
+                data = f.read(statsBlock)
+            return
+        d = zlib.decompressobj(31)
+        while len(data) > 0:
+            block = d.decompress(data)
+            while d.eof and len(d.unused_data) > 0:
+                data = d.unused_data
+                d = zlib.decompressobj(31)
+                block += d.decompress(data)
+            if len(block) > 0:
+                yield block
+            data = f.read(statsBlock)
+
+
+# statistics of a batch of quality lines: number of bases and sum of the quality values
+def qualitySum(quals):
+    joined = b"".join(quals)
+    if numpy is not None:
+        return len(joined), int(numpy.frombuffer(joined, dtype=numpy.uint8).sum(dtype=numpy.uint64))
+    return len(joined), sum(joined)
+
+
+# single pass statistics of a FASTQ file: number of reads, length distribution and mean quality (Phred+33).
+# The reads are processed in batches of complete records, if stop is given reading ends after that many reads.
+def fastqStats(path, stop=None):
+    reads = 0
+    bases = 0
+    qualsum = 0
+    lengths = Counter()
+    rest = b""
+    complete = True
+    for block in fastqBlocks(path):
+        if b"\r" in block:
+            block = block.replace(b"\r", b"")
+        lines = (rest + block).split(b"\n")
+        # only complete records, the remaining lines are kept for the next block
+        n = (len(lines) - 1) // 4 * 4
+        rest = b"\n".join(lines[n:])
+        seqs = lines[1:n:4]
+        lengths.update(map(len, seqs))
+        b, q = qualitySum(lines[3:n:4])
+        bases += b
+        qualsum += q
+        reads += len(seqs)
+        if stop is not None and reads >= stop:
+            complete = False
+            break
+    if complete and len(rest.strip()) > 0:
+        # last record without a final newline
+        lines = rest.split(b"\n")
+        if len(lines) >= 4:
+            lengths[len(lines[1])] += 1
+            b, q = qualitySum([lines[3]])
+            bases += b
+            qualsum += q
+            reads += 1
+    result = dict()
+    result["reads"] = reads
+    result["minlen"] = min(lengths) if reads > 0 else 0
+    result["maxlen"] = max(lengths) if reads > 0 else 0
+    result["lengths"] = dict(lengths)
+    result["meanqual"] = (float(qualsum) / bases - 33.0) if bases > 0 else 0.0
+    result["complete"] = complete
+    return result
+
+
+# statistics of both mates, read at the same time
+def fastqPairStats(file1, file2, stop=None):
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        stats = list(pool.map(lambda f: fastqStats(f, stop), (file1, file2)))
+    if stats[0]["complete"] and stats[1]["complete"] and stats[0]["reads"] != stats[1]["reads"]:
+        logging.warning("The mates " + file1 + " and " + file2 + " have different numbers of reads (" +
+                        str(stats[0]["reads"]) + " and " + str(stats[1]["reads"]) + ")\n")
+    return stats
+
+
+# QC store: one row per run, sample, QC step (raw, trimmed, filtered, host) and mate with the read statistics and the
+# identity of the file they were read from, the read length distributions and the FastQC modules
+qcSchema = """
+CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY, outdir TEXT, started TEXT, host TEXT);
+CREATE TABLE IF NOT EXISTS readstats (run TEXT, sample TEXT, step TEXT, mate INTEGER, reads INTEGER,
+    minlen INTEGER, maxlen INTEGER, meanqual REAL, complete INTEGER, file TEXT,
+    PRIMARY KEY (run, sample, step, mate));
+CREATE INDEX IF NOT EXISTS readstats_file ON readstats (file);
+CREATE TABLE IF NOT EXISTS lengths (run TEXT, sample TEXT, step TEXT, mate INTEGER, length INTEGER, count INTEGER,
+    PRIMARY KEY (run, sample, step, mate, length));
+CREATE TABLE IF NOT EXISTS fastqc (run TEXT, sample TEXT, step TEXT, mate INTEGER, module TEXT, status TEXT,
+    PRIMARY KEY (run, sample, step, mate, module));
+CREATE TABLE IF NOT EXISTS fastqcrows (run TEXT, sample TEXT, step TEXT, mate INTEGER, module TEXT, row INTEGER,
+    data TEXT, PRIMARY KEY (run, sample, step, mate, module, row));
+"""
+qcLock = threading.Lock()
+
+
+# open the QC store
+def qcConnect(path=None):
+    db = sqlite3.connect(path or variables["qcstore"], timeout=600)
+    db.executescript(qcSchema)
+    return db
+
+
+# record the start of a run
+def storeRun(outdir):
+    variables["run"] = datetime.now().strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid())
+    with qcLock, closing(qcConnect()) as db, db:
+        db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)",
+                   (variables["run"], os.path.abspath(outdir), str(datetime.now()), socket.gethostname()))
+
+
+# store the statistics of both mates of a sample at a QC step (files: None if they were read from a stream)
+def storeStats(s, step, files, stats):
+    key = (variables["run"], s, step)
+    with qcLock, closing(qcConnect()) as db, db:
+        db.execute("DELETE FROM lengths WHERE run = ? AND sample = ? AND step = ?", key)
+        for mate, st in enumerate(stats, 1):
+            identity = fileIdentity(files[mate - 1]) if files is not None and st["complete"] else None
+            db.execute("INSERT OR REPLACE INTO readstats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       key + (mate, st["reads"], st["minlen"], st["maxlen"], st["meanqual"], int(st["complete"]),
+                              identity))
+            db.executemany("INSERT INTO lengths VALUES (?, ?, ?, ?, ?, ?)",
+                           [key + (mate, length, count) for length, count in st["lengths"].items()])
+
+
+# statistics of unchanged files from the QC store (of any run), None if they were not read completely before
+def storedStats(files):
+    stats = list()
+    with qcLock, closing(qcConnect()) as db:
+        for f in files:
+            row = db.execute("SELECT run, sample, step, mate, reads, minlen, maxlen, meanqual FROM readstats "
+                             "WHERE file = ? AND complete = 1 ORDER BY run DESC LIMIT 1",
+                             (fileIdentity(f),)).fetchone()
+            if row is None:
+                return None
+            lengths = db.execute("SELECT length, count FROM lengths WHERE run = ? AND sample = ? AND step = ? AND "
+                                 "mate = ?", row[:4]).fetchall()
+            stats.append({"reads": row[4], "minlen": row[5], "maxlen": row[6], "meanqual": row[7],
+                          "lengths": dict(lengths), "complete": True})
+    return stats
+
+
+# statistics of both mates at a QC step, read from the store if the files did not change since they were last read
+def qcStats(s, step, files, stop=None, fn=None):
+    stats = storedStats(files)
+    if stats is not None:
+        logging.info(step.capitalize() + " statistics of sample " + s + " taken from the QC store\n")
     else:
-        pair = True
-
-    if pair:
-        short1 = variables["pairID1"][:-1]
-        print(short1)
-        short2 = variables["pairID2"][:-1]
-        for i in os.listdir(indir + "/fastqc/"):
-            print(i)
-            if i.startswith(samplename + short1) and i.endswith('zip'):
-                file1 = indir + "/fastqc/" + i
-            if i.startswith(samplename + short2) and i.endswith('zip'):
-                file2 = indir + "/fastqc/" + i
-        command = subprocess.Popen(['unzip', '-o', '-d', indir + "/fastqc", file1])
-        command.wait()
-        command = subprocess.Popen(['unzip', '-o', '-d', indir + "/fastqc", file2])
-        command.wait()
-        print(file1)
-        sub1 = re.sub("\.zip", "", file1)
-        print(sub1)
-        #filename1 = sub1 + "/fastqc_data.txt"
-        sub2 = re.sub("\.zip", "", file2)
-        filename2 = sub2 + "/fastqc_data.txt"
-        #tuple1 = fastqcData(filename1)
-        tuple2 = fastqcData(filename2)
-
-        # for now, return tuple2
-        return tuple2
+        stats = (fn or fastqPairStats)(files[0], files[1], stop)
+    storeStats(s, step, files, stats)
+    return stats
+
+
+# breakpoint value from the QC store: the smallest read count of the mates of a sample at a QC step
+def qcReads(s, step):
+    with qcLock, closing(qcConnect()) as db:
+        return db.execute("SELECT MIN(reads) FROM readstats WHERE run = ? AND sample = ? AND step = ?",
+                          (variables["run"], s, step)).fetchone()[0]
+
+
+# breakpoint value from the QC store: share of the R2 reads lost between two QC steps of a sample
+def qcLoss(s, before, after):
+    with qcLock, closing(qcConnect()) as db:
+        return db.execute("SELECT 1.0 - CAST(a.reads AS REAL) / b.reads FROM readstats a JOIN readstats b "
+                          "ON a.run = b.run AND a.sample = b.sample AND a.mate = b.mate "
+                          "WHERE a.run = ? AND a.sample = ? AND a.mate = 2 AND b.step = ? AND a.step = ?",
+                          (variables["run"], s, before, after)).fetchone()[0]
+
+
+# store all modules of the FastQC reports of both mates
+def storeFastqc(s, step, reports):
+    key = (variables["run"], s, step)
+    with qcLock, closing(qcConnect()) as db, db:
+        db.execute("DELETE FROM fastqc WHERE run = ? AND sample = ? AND step = ?", key)
+        db.execute("DELETE FROM fastqcrows WHERE run = ? AND sample = ? AND step = ?", key)
+        for mate, report in enumerate(reports, 1):
+            for name, module in readFastqc(report).items():
+                db.execute("INSERT INTO fastqc VALUES (?, ?, ?, ?, ?, ?)", key + (mate, name, module["status"]))
+                db.executemany("INSERT INTO fastqcrows VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               [key + (mate, name, i, json.dumps(row)) for i, row in enumerate(module["rows"])])
+    logging.info("Stored the FastQC reports of sample " + s + " (" + step + ")\n")
+
+
+# merge the QC values of a sample in the store of a batch job into the QC store of the run
+def mergeQc(path, s):
+    with qcLock, closing(qcConnect()) as db:
+        db.execute("ATTACH DATABASE ? AS job", (path,))
+        with db:
+            for table in ("readstats", "lengths", "fastqc", "fastqcrows"):
+                db.execute("DELETE FROM " + table + " WHERE run = ? AND sample = ?", (variables["run"], s))
+                db.execute("INSERT INTO " + table + " SELECT * FROM job." + table + " WHERE run = ? AND sample = ?",
+                           (variables["run"], s))
+        db.execute("DETACH DATABASE job")
+
+
+# statistics of a FASTA file (no qualities)
+def fastaStats(path):
+    lengths = Counter(len(b"".join(lines)) for name, lines in readRecords(path))
+    reads = sum(lengths.values())
+    return {"reads": reads, "minlen": min(lengths) if reads > 0 else 0, "maxlen": max(lengths) if reads > 0 else 0,
+            "lengths": dict(lengths), "meanqual": None, "complete": True}
+
+
+# host filter QC: reads left after filtering and reads assigned to the host
+def filteredQC(s, filtered, host):
+    def pairStats(file1, file2, stop):
+        return [fastaStats(file1), fastaStats(file2)]
+
+    kept = qcStats(s, "filtered", filtered, fn=pairStats)
+    removed = qcStats(s, "host", host, fn=pairStats)
+    for mate, k, r in zip(("R1", "R2"), kept, removed):
+        logging.info("Host filtering for sample " + s + ", " + mate + ": " + str(k["reads"]) + " reads kept, " +
+                     str(r["reads"]) + " host reads\n")
+
+
+# raw QC breakpoint: enough reads in the raw data?
+def rawQC(s, qc, raw):
+    # in preview mode the threshold shrinks with the share of the reads that was sampled
+    threshold = int(math.ceil(variables["rawabsolute"] * previewScale.get(s, 1.0)))
+    stop = threshold if variables["rawearlystop"] else None
+    t1 = qcStats(s, "raw", raw, stop)
+    qc["raw"] = t1
+    num = qcReads(s, "raw")
+    if num < threshold:
+        logging.error("Breakpoint: Raw QC for sample " + s + " failed with a read count of only " + str(num) + "\n")
+        #loghandle.write("Breakpoint: Raw QC for sample " + s + " failed with a read count of only " + t1[2] + "\n")
+        return False
+    if t1[0]["complete"]:
+        logStats(s, "Raw", t1)
     else:
-        for i in os.listdir(indir + "/fastqc/"):
-            if i.startswith(samplename) and i.endswith('zip'):
-                file1 = indir + "/fastqc/" + i
-        command = subprocess.Popen(['unzip', '-o', '-d', indir + "/fastqc", file1])
-        command.wait()
-        sub = re.sub("\.zip", "", file1)
-        filename1 = sub + "/fastqc_data.txt"
-        tuple1 = fastqcData(filename1)
-        return tuple1
-
-
-# read a file from FastQC
-def fastqcData(qcdata):
-    mini = 0
-    maxi = 0
-    num = 0
-    with open(qcdata, 'rU') as qc:
-        for line in qc:
-            line = re.sub('\n', "", line)
-            # number of sequences
-            if line.startswith("Total Sequences"):
-                s = re.split('\t', line)
-                num = s[-1]
-            # min/max length
-            if line.startswith("Sequence length"):
-                s = re.split('\t', line)
-                tmp = s[-1]
-                if re.search("-", tmp):
-                    split = re.split("-", tmp)
-                    mini = split[0]
-                    maxi = split[1]
-                else:
-                    mini = tmp
-                    maxi = tmp
-
-    result = mini, maxi, num
-    return result
+        logging.info("Raw QC for sample: " + s + " passed after " + str(num) + " reads\n")
+    return True
 
 
-# run full analysis
-def runAnalysis(indir, outdir, config):
-    global logfile
+# full statistics of the raw reads if the raw QC breakpoint stopped early
+def rawStats(s, qc, raw):
+    qc["raw"] = qcStats(s, "raw", raw)
+    logStats(s, "Raw", qc["raw"])
+
+
+# trimmed QC breakpoint: did trimming lose too many reads?
+def trimmedQC(s, qc, trimmed, t2=None):
+    if t2 is None:
+        t2 = qcStats(s, "trimmed", trimmed)
+    else:
+        # read from the stream
+        storeStats(s, "trimmed", None, t2)
+    qc["trimmed"] = t2
+    raw2trimloss = qcLoss(s, "raw", "trimmed")
+    if raw2trimloss > variables["raw2trimloss"]:
+        logging.error("Breakpoint: Trimmed QC for sample " + s + " failed with a loss of " + str(raw2trimloss) +
+                      " compared to raw read counts\n")
+        #loghandle.write("Breakpoint: Trimmed QC for sample " + s + " failed with a loss of " + str(raw2trimloss) +
+        #                " compared to raw read counts\n")
+        return False
+    logStats(s, "Trimmed", t2)
+    return True
+
+
+# the stages of one sample as a dependency graph
+# every stage has a function to run, the stages it depends on and the module (branch) it belongs to.
+# A stage may return False (a failed breakpoint) to stop all stages that depend on it.
+# Stages running a tool are checkpointed, they list the tool, their input and their output files.
+# All paths come from the sample manifest.
+def sampleStages(s):
+    qc = dict()
+    stages = dict()
+    m = manifest[s]
+    raw = m["raw"]
+    trimmed = m["trimmed"]
+    # always run preprocessing, the breakpoints read the statistics of the reads directly
+    stages["rawqc"] = {"run": lambda: rawQC(s, qc, raw), "deps": [], "module": None}
+    stages["trim"] = {"run": lambda: trim(s, raw, trimmed), "deps": ["rawqc"], "module": None,
+                      "tool": "trim", "inputs": raw, "outputs": trimmed}
+    stages["trimqc"] = {"run": lambda: trimmedQC(s, qc, trimmed), "deps": ["trim"], "module": None}
+    if variables["rawearlystop"]:
+        stages["rawstats"] = {"run": lambda: rawStats(s, qc, raw), "deps": ["rawqc"], "module": None}
+        stages["trimqc"]["deps"].append("rawstats")
+    # FastQC reports are optional and nothing waits for them
+    if variables["fastqcreport"]:
+        stages["fastqc"] = {"run": lambda: fastqc(s, raw, os.path.dirname(m["fastqc"][0])), "deps": [],
+                            "module": None, "tool": "fastqc", "inputs": raw, "outputs": m["fastqc"]}
+        stages["fastqcTrimmed"] = {"run": lambda: fastqc(s, trimmed, os.path.dirname(m["fastqcTrimmed"][0])),
+                                   "deps": ["trim"], "module": None, "tool": "fastqc", "inputs": trimmed,
+                                   "outputs": m["fastqcTrimmed"]}
+        stages["fastqcStore"] = {"run": lambda: storeFastqc(s, "raw", m["fastqc"]), "deps": ["fastqc"],
+                                 "module": None}
+        stages["fastqcTrimmedStore"] = {"run": lambda: storeFastqc(s, "trimmed", m["fastqcTrimmed"]),
+                                        "deps": ["fastqcTrimmed"], "module": None}
+    # the modules read the trimmed reads or the unique pairs of them
+    reads = trimmed
+    start = "trimqc"
+    if variables["dedup"]:
+        stages["dedup"] = {"run": lambda: dedup(s, trimmed, m["dedup"]), "deps": ["trimqc"], "module": None,
+                           "tool": "dedup", "inputs": trimmed, "outputs": m["dedup"]}
+        reads = m["dedup"]
+        start = "dedup"
+    # run the different modules, they only depend on the trimmed reads
+    # Basic Metagenomics
+    if variables["basic"]:
+        stages["diamond"] = {"run": lambda: diamond(s, reads, m["basicDaa"]), "deps": [start],
+                             "module": "basic", "tool": "diamond", "inputs": reads, "outputs": m["basicDaa"]}
+        stages["daa2rma"] = {"run": lambda: daa2rma(s, m["basicDaa"], m["basicRma"]), "deps": ["diamond"],
+                             "module": "basic", "tool": "daa2rma", "inputs": m["basicDaa"],
+                             "outputs": [m["basicRma"]]}
+    # Host-Associated Data
+    if variables["filterHost"]:
+        stages["filterHost"] = {"run": lambda: filterHost(s, reads, m["hostRma"], m["filtered"], m["host"]),
+                                "deps": [start], "module": "filterHost", "tool": "filterHost", "inputs": reads,
+                                "outputs": m["filtered"] + m["hostRma"] + m["host"]}
+        stages["filterqc"] = {"run": lambda: filteredQC(s, m["filtered"], m["host"]), "deps": ["filterHost"],
+                              "module": "filterHost"}
+        stages["diamondFasta"] = {"run": lambda: diamondFasta(s, m["filteredQuery"], m["hostDaa"]),
+                                  "deps": ["filterHost"], "module": "filterHost", "tool": "diamond",
+                                  "inputs": m["filteredQuery"], "outputs": m["hostDaa"]}
+        stages["hostdaa2rma"] = {"run": lambda: daa2rma(s, m["hostDaa"], m["hostMegan"]),
+                                 "deps": ["diamondFasta"], "module": "filterHost", "tool": "daa2rma",
+                                 "inputs": m["hostDaa"], "outputs": [m["hostMegan"]]}
+    # Taxonomic Analysis
+    if variables["16S"]:
+        stages["select16S"] = {"run": lambda: select16S(s, reads, m["selected16S"]), "deps": [start],
+                               "module": "16S", "tool": "select16S", "inputs": reads,
+                               "outputs": [m["extraction16S"], m["taxonomy16S"]]}
+        stages["malt"] = {"run": lambda: malt(s, m["extraction16S"], m["rma16S"]), "deps": ["select16S"],
+                          "module": "16S", "tool": "malt", "inputs": [m["extraction16S"]],
+                          "outputs": [m["rma16S"]]}
+    # batched MALT calls get their memory when the batch runs (see MaltBatcher)
+    for name in ("filterHost", "malt"):
+        if name in stages and variables["maltbatch"] > 1:
+            stages[name]["batched"] = True
+    # taxon counts of the sample for the abundance matrices
+    if variables["abundance"]:
+        counts = m["counts"]
+        if "select16S" in stages:
+            stages["counts16S"] = {"run": lambda: taxonomyCounts(s, m["taxonomy16S"], counts["16S"]),
+                                   "deps": ["select16S"], "module": "16S", "tool": "taxonomy16S",
+                                   "inputs": [m["taxonomy16S"]], "outputs": [counts["16S"]]}
+        for source, name, rma in (("16Smalt", "malt", m["rma16S"]), ("basic", "daa2rma", m["basicRma"]),
+                                  ("host", "hostdaa2rma", m["hostMegan"])):
+            if name in stages:
+                stages["counts" + source] = {"run": lambda rma=rma, source=source: rmaCounts(s, rma, counts[source]),
+                                             "deps": [name], "module": stages[name]["module"], "tool": "rma2info",
+                                             "inputs": [rma], "outputs": [counts[source]]}
+    if variables["streamtrimmed"]:
+        streamStages(s, qc, stages)
+    return stages
+
+
+# streaming mode: trimming, the trimmed QC breakpoint and all tools reading the trimmed reads from the stream become
+# one stage "trim" (see streamTrim), the stages that depended on them depend on it instead
+def streamStages(s, qc, stages):
+    m = manifest[s]
+    names = {"fastqc": "fastqcTrimmed"}
+    # only stages reading the trimmed reads themselves (not the unique pairs) can be streamed
+    streamed = [names.get(t, t) for t in variables["streamto"]
+                if names.get(t, t) in stages and stages[names.get(t, t)].get("inputs") == m["trimmed"]]
+    if "diamond" in streamed and len(m["basicDaa"]) != 1:
+        # DIAMOND would read the mates one after the other when they are aligned separately
+        streamed.remove("diamond")
+    readers = [name for name, stage in stages.items() if stage.get("inputs") == m["trimmed"] and name != "trim"]
+    ondisk = variables["keeptrimmed"] or any(name not in streamed for name in readers)
+    outputs = list(m["trimmed"]) if ondisk else list()
+    for name in streamed:
+        outputs += stages[name]["outputs"]
+    for name in streamed + ["trimqc", "rawstats"]:
+        stages.pop(name, None)
+    for stage in stages.values():
+        stage["deps"] = ["trim" if d in streamed or d == "trimqc" else d for d in stage["deps"]]
+    stages["trim"] = {"run": lambda: streamTrim(s, qc, streamed, ondisk), "deps": ["rawqc"], "module": None,
+                      "tool": "stream", "inputs": m["raw"], "outputs": outputs}
+    # the memory of all tools running in the stage, the host filter runs MALT for both mates at once
+    stages["trim"]["parts"] = ["trim"] + streamed + (["filterHost"] if "filterHost" in streamed else [])
+
+
+# size of the blocks copied from prinseq++ to the tools reading the stream, and how many of them may wait for a
+# slow reader before the stream is held back
+streamBlock = 1 << 20
+streamQueue = 64
+
+
+# copy one mate written by prinseq++ into the queues of all of its outputs
+def teeStream(source, queues):
+    try:
+        with open(source, 'rb') as f:
+            block = f.read(streamBlock)
+            while len(block) > 0:
+                for q in queues:
+                    q.put(block)
+                block = f.read(streamBlock)
+    finally:
+        for q in queues:
+            q.put(None)
+
+
+# write the blocks of a queue into a named pipe or file. A pipe is dropped (the rest of the stream is discarded) if
+# its reader stops reading or the tool of the reader finished (done) without ever opening it.
+def teeWriter(path, blocks, done, threads=1):
+    fd = None
+    block = b""
+    try:
+        if path.endswith(".gz") and not (os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode)):
+            with BgzfWriter(path, threads) as out:
+                block = blocks.get()
+                while block is not None:
+                    out.write(block)
+                    block = blocks.get()
+            return
+        if os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode):
+            while fd is None:
+                try:
+                    fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+                    os.set_blocking(fd, True)
+                except OSError as e:
+                    if e.errno != errno.ENXIO:
+                        raise
+                    if done is not None and done.is_set():
+                        logging.warning("Nothing read the stream " + path + "\n")
+                        break
+                    time.sleep(0.05)
+        else:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        block = blocks.get()
+        while block is not None:
+            view = memoryview(block)
+            while fd is not None and len(view) > 0:
+                try:
+                    view = view[os.write(fd, view):]
+                except BrokenPipeError:
+                    logging.warning("The reader of " + path + " stopped reading the stream\n")
+                    os.close(fd)
+                    fd = None
+            block = blocks.get()
+    finally:
+        if fd is not None:
+            os.close(fd)
+        # keep the tee going in any case
+        while block is not None:
+            block = blocks.get()
+
+
+# run a part of the streaming stage in its own thread, with the sample, threads and collected exit status of the stage
+def streamWorker(s, name, threads, shared, fn, done=None):
+    def work():
+        current.sample = s
+        current.stage = name
+        current.threads = threads
+        current.returncodes = shared["returncodes"]
+        current.processes = shared["processes"]
+        current.pipes = "stream"
+        try:
+            fn()
+        except ToolError as e:
+            if e.stopped:
+                logging.info("Stopped " + name + " of sample " + s + "\n")
+            else:
+                logging.error("Streaming " + name + " of sample " + s + " failed: " + str(e) + "\n")
+        except Exception:
+            logging.exception("Streaming " + name + " of sample " + s + " failed\n")
+            if shared["returncodes"] is not None:
+                shared["returncodes"].append(-1)
+        finally:
+            current.returncodes = None
+            current.processes = None
+            current.pipes = False
+            if done is not None:
+                done.set()
+    worker = threading.Thread(target=work)
+    worker.start()
+    return worker
+
+
+# Trimming with the tools reading the trimmed reads attached through named pipes.
+# prinseq++ writes both mates into pipes, every mate is copied (teeStream) to the pipes of the streamed tools, of the
+# statistics for the trimmed QC breakpoint and, if needed, to the trimmed file. All of them run at the same time.
+# The breakpoint is checked as soon as the whole stream was read; if it fails the tools still running are stopped.
+def streamTrim(s, qc, streamed, ondisk):
+    m = manifest[s]
+    trimmed = m["trimmed"]
+    streamdir = os.path.dirname(trimmed[0]) + "/.stream_" + s
+    if os.path.exists(streamdir):
+        shutil.rmtree(streamdir)
+    logging.info(str(datetime.now()) + ": Streaming trimmed reads to " + ", ".join(streamed) + "\n")
+    outputs = ([], [])
+
+    # named pipes with the names of the trimmed files (FastQC names its reports after them)
+    def pipes(name, mates, done=None):
+        os.makedirs(streamdir + "/" + name, exist_ok=True)
+        paths = list()
+        for k in mates:
+            path = streamdir + "/" + name + "/" + os.path.basename(plainName(trimmed[k]))
+            os.mkfifo(path)
+            outputs[k].append((path, done))
+            paths.append(path)
+        return paths
+
+    consumers = list()
+    if "diamond" in streamed:
+        consumers.append(("diamond", [0, 1], lambda p: diamond(s, p, m["basicDaa"])))
+    if "filterHost" in streamed:
+        # one malt-run per mate, they have to read at the same time
+        for k in (0, 1):
+            consumers.append(("filterHost", [k], lambda p, k=k: filterHost(s, p, [m["hostRma"][k]],
+                                                                            [m["filtered"][k]], [m["host"][k]],
+                                                                            batch=False)))
+    if "select16S" in streamed:
+        consumers.append(("select16S", [0, 1], lambda p: select16S(s, p, m["selected16S"])))
+    if "fastqcTrimmed" in streamed:
+        for k in (0, 1):
+            consumers.append(("fastqcTrimmed", [k],
+                              lambda p: fastqc(s, p, os.path.dirname(m["fastqcTrimmed"][0]))))
+    tools = len(set(c[0] for c in consumers if c[0] != "fastqcTrimmed")) + 1
+    threads = max(1, toolThreads() // tools)
+    shared = {"returncodes": getattr(current, "returncodes", None), "processes": list()}
+    workers = list()
+    try:
+        for i, (name, mates, fn) in enumerate(consumers):
+            done = threading.Event()
+            paths = pipes(name + str(i), mates, done)
+            workers.append(streamWorker(s, name, threads, shared, lambda fn=fn, paths=paths: fn(paths), done))
+        stats = [None, None]
+        statpipes = pipes("stats", [0, 1])
+        statworkers = list()
+        for k in (0, 1):
+            statworkers.append(streamWorker(s, "trimqc", 1, shared,
+                                            lambda k=k: stats.__setitem__(k, fastqStats(statpipes[k]))))
+        if not qc["raw"][0]["complete"]:
+            # the raw QC breakpoint stopped early, the full raw statistics are needed for the trimmed breakpoint
+            statworkers.append(streamWorker(s, "rawstats", 1, shared, lambda: rawStats(s, qc, m["raw"])))
+        if ondisk:
+            os.makedirs(os.path.dirname(trimmed[0]), exist_ok=True)
+            outputs[0].append((trimmed[0], None))
+            outputs[1].append((trimmed[1], None))
+        os.makedirs(streamdir + "/prinseq")
+        sources = [streamdir + "/prinseq/" + os.path.basename(plainName(f)) for f in trimmed]
+        for path in sources:
+            os.mkfifo(path)
+        tees = list()
+        for k in (0, 1):
+            queues = list()
+            for path, done in outputs[k]:
+                blocks = queue.Queue(streamQueue)
+                queues.append(blocks)
+                tees.append(threading.Thread(target=teeWriter, args=(path, blocks, done, threads)))
+            tees.append(threading.Thread(target=teeStream, args=(sources[k], queues)))
+        for t in tees:
+            t.start()
+        streamWorker(s, "trim", threads, shared, lambda: trim(s, m["raw"], sources)).join()
+        for path in sources:
+            # a tee still waiting for prinseq++ to open its output (e.g. prinseq++ failed) gets an empty stream
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        for worker in statworkers:
+            worker.join()
+        passed = stats[0] is not None and stats[1] is not None and trimmedQC(s, qc, trimmed, stats)
+        if not passed:
+            logging.info("Stopping the tools reading the trimmed reads of sample " + s + "\n")
+            stopCommands(shared["processes"])
+        for t in tees + workers:
+            t.join()
+    except BaseException:
+        stopCommands(shared["processes"])
+        raise
+    finally:
+        shutil.rmtree(streamdir, ignore_errors=True)
+    return passed
+
+
+# run one stage in a worker thread of the scheduler
+def runStage(s, name, stage, threads):
+    current.sample = s
+    current.stage = name
+    current.threads = threads
+    need = None
+    if "tool" in stage and not stage.get("batched", False):
+        parts = stage.get("parts", [name])
+        need = sum(memoryBudget.estimate(p, stage["tool"]) for p in parts)
+    start = time.time()
+    # done, stopped (by a breakpoint) or failed (raised)
+    outcome = "failed"
+    try:
+        if "tool" in stage:
+            result = checkpoint(s, name, stage["tool"], stage["inputs"], stage["outputs"], stage["run"], need)
+        else:
+            result = stage["run"]()
+        outcome = "stopped" if result is False else "done"
+        return result is not False
+    finally:
+        with reportLock:
+            report["stages"].append({"sample": s, "stage": name, "start": str(datetime.fromtimestamp(start)),
+                                     "wall": round(time.time() - start, 3), "result": outcome})
+        current.sample = None
+        current.stage = None
+        current.threads = None
+
+
+# run the stage graph of a sample, every stage starts as soon as all stages it depends on are done.
+# The threads of the sample are split evenly between the modules that run at the same time.
+def runStages(s, stages):
+    modules = set(stage["module"] for stage in stages.values() if stage["module"] is not None)
+    branchthreads = max(1, toolThreads() // max(1, len(modules)))
+    status = dict()
+    running = dict()
+    with ThreadPoolExecutor(max_workers=len(stages)) as pool:
+        while len(status) < len(stages):
+            for name, stage in stages.items():
+                if name in status or name in running.values():
+                    continue
+                deps = [status.get(d) for d in stage["deps"]]
+                if any(d in ("failed", "stopped", "skipped") for d in deps):
+                    status[name] = "skipped"
+                    logging.info("Skipping stage " + name + " of sample " + s + "\n")
+                elif all(d == "done" for d in deps):
+                    threads = branchthreads if stage["module"] is not None else toolThreads()
+                    running[pool.submit(runStage, s, name, stage, threads)] = name
+            if len(running) == 0:
+                continue
+            finished, pending = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    status[name] = "done" if future.result() else "stopped"
+                except ToolError as e:
+                    logging.error("Stage " + name + " of sample " + s + " failed: " + str(e) + "\n")
+                    status[name] = "failed"
+                except Exception:
+                    logging.exception("Stage " + name + " of sample " + s + " failed\n")
+                    status[name] = "failed"
+    return status
+
+
+# run the full analysis of one sample, this is what the workers of runAnalysis execute
+def processSample(s):
+    current.sample = s
+    handler = sampleLog(s)
+    maltBatcher.begin(s)
+    try:
+        return runStages(s, sampleStages(s))
+    except Exception:
+        logging.exception("Processing of sample " + s + " failed\n")
+        return {"sample": "failed"}
+    finally:
+        maltBatcher.end(s)
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+        current.sample = None
+
+
+# sum up the resource usage of the tool calls per stage
+def reportSummary():
+    summary = dict()
+    for c in report["commands"]:
+        if c["stage"] not in summary:
+            summary[c["stage"]] = {"calls": 0, "failed": 0, "wall": 0.0, "cpu": 0.0, "maxrss": 0, "read": 0,
+                                   "written": 0}
+        st = summary[c["stage"]]
+        st["calls"] += 1
+        st["failed"] += 1 if c["returncode"] != 0 else 0
+        st["wall"] += c["wall"]
+        st["cpu"] += (c["user"] or 0.0) + (c["sys"] or 0.0)
+        st["maxrss"] = max(st["maxrss"], c["maxrss"] or 0)
+        st["read"] += c["rchar"] or 0
+        st["written"] += c["wchar"] or 0
+    return summary
+
+
+# write the run report (JSON with all tool calls and stages, CSV with the tool calls) and log a summary per stage
+def writeReport(wall):
+    report["wall"] = round(wall, 3)
+    report["summary"] = reportSummary()
+    with open(variables["report"] + ".json", 'w') as r:
+        json.dump(report, r, indent=1)
+    fields = ["sample", "stage", "tool", "start", "wall", "user", "sys", "maxrss", "rchar", "wchar", "read_bytes",
+              "write_bytes", "returncode", "timedout", "stopped", "command"]
+    with open(variables["report"] + ".csv", 'w', newline='') as r:
+        writer = csv.DictWriter(r, fieldnames=fields)
+        writer.writeheader()
+        for c in report["commands"]:
+            writer.writerow(c)
+    lines = ["%-16s %6s %6s %12s %12s %12s %12s %12s" % ("stage", "calls", "failed", "wall [s]", "cpu [s]",
+                                                           "max RSS [MB]", "read [MB]", "written [MB]")]
+    for stage, st in sorted(report["summary"].items(), key=lambda x: -x[1]["wall"]):
+        lines.append("%-16s %6d %6d %12.1f %12.1f %12.1f %12.1f %12.1f" % (
+            stage, st["calls"], st["failed"], st["wall"], st["cpu"], st["maxrss"] / 1024.0, st["read"] / 1048576.0,
+            st["written"] / 1048576.0))
+    lines.append("Total wall time: %.1f s" % wall)
+    logging.info("Resource usage per stage:\n" + "\n".join(lines) + "\n")
+    print("\n".join(lines))
+
+
+# Watch mode: poll the input directory and hand every sample to the workers as soon as both of its read files are
+# complete, i.e. their size and modification time did not change between two polls. Watching ends when the sentinel
+# file appears in the input directory and all read files there were handed over, or after watchidle seconds without
+# new samples and with all samples processed.
+def watchInput(indir, submit):
+    seen = dict()
+    last = time.time()
+    logging.info(str(datetime.now()) + ": Watching " + indir + " for new samples\n")
+    while True:
+        pairs = scanInput(indir)
+        ready = dict()
+        pending = 0
+        for sample, files in pairs.items():
+            if sample in submit.submitted:
+                continue
+            if None in files:
+                pending += 1
+                continue
+            try:
+                state = [(os.path.getsize(indir + "/" + f), os.path.getmtime(indir + "/" + f)) for f in files]
+            except OSError:
+                continue
+            if all(seen.get(f) == st for f, st in zip(files, state)):
+                ready[sample] = files
+            else:
+                pending += 1
+            for f, st in zip(files, state):
+                seen[f] = st
+        if len(ready) > 0:
+            logging.info(str(datetime.now()) + ": New samples " + ", ".join(sorted(ready)) + "\n")
+            registerSamples(indir, ready)
+            for sample in sorted(ready):
+                submit(sample)
+            last = time.time()
+        if os.path.exists(indir + "/" + variables["watchsentinel"]) and pending == 0 and len(ready) == 0:
+            logging.info(str(datetime.now()) + ": Found " + variables["watchsentinel"] + ", stopped watching\n")
+            break
+        if variables["watchidle"] > 0 and time.time() - last > variables["watchidle"] and submit.idle():
+            logging.info(str(datetime.now()) + ": No new samples for " + str(variables["watchidle"]) +
+                         " s, stopped watching\n")
+            break
+        time.sleep(variables["watchinterval"])
+    for sample, files in scanInput(indir).items():
+        if None in files and sample not in submit.submitted:
+            logging.error("Sample " + sample + " does not have both mates in the input directory, skipping it\n")
+
+
+# sources of the abundance matrices
+abundanceSources = ["16S", "16Smalt", "basic", "host"]
+
+
+# one array in NumPy's .npy format: a 1-dimensional array of int64 ('<i8'), float64 ('<f8') or strings ('<U')
+def npyArray(values, dtype):
+    if dtype == '<U':
+        width = max([len(v) for v in values] + [1])
+        dtype = '<U' + str(width)
+        data = b"".join(v.encode("utf-32-le").ljust(4 * width, b"\0") for v in values)
+    else:
+        data = struct.pack('<' + str(len(values)) + {'i': 'q', 'f': 'd'}[dtype[1]], *values)
+    header = "{'descr': '" + dtype + "', 'fortran_order': False, 'shape': (" + str(len(values)) + ",), }"
+    # the header is padded so that the data starts at a multiple of 64 bytes
+    header += " " * (63 - (10 + len(header)) % 64) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack('<H', len(header)) + header.encode("latin1") + data
+
+
+# Sample x taxon abundance matrices, one per source. The counts of a sample are added when it is finished and the
+# matrix of the source is written again (05_abundance/<source>.npz). The files are sparse matrices in coordinate
+# format as written by scipy.sparse.save_npz (row, col, data, shape), with the names of the rows (samples) and
+# columns (taxa), and can be read with numpy.load or scipy.sparse.load_npz.
+class AbundanceMatrix:
+    def __init__(self, directory):
+        self.directory = directory
+        self.counts = {source: dict() for source in abundanceSources}
+        self.lock = threading.Lock()
+
+    def add(self, s):
+        with self.lock:
+            for source in abundanceSources:
+                path = manifest[s]["counts"][source]
+                if os.path.exists(path):
+                    self.counts[source][s] = readCounts(path)
+                    self.write(source)
+
+    def write(self, source):
+        samples = sorted(self.counts[source])
+        taxa = sorted(set(t for counts in self.counts[source].values() for t in counts))
+        columns = {taxon: col for col, taxon in enumerate(taxa)}
+        rows, cols, data = list(), list(), list()
+        for row, s in enumerate(samples):
+            for taxon, count in sorted(self.counts[source][s].items()):
+                rows.append(row)
+                cols.append(columns[taxon])
+                data.append(count)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        path = self.directory + "/" + source + ".npz"
+        with zipfile.ZipFile(path + ".tmp", 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr("format.npy", npyArray(["coo"], '<U'))
+            z.writestr("shape.npy", npyArray([len(samples), len(taxa)], '<i8'))
+            z.writestr("row.npy", npyArray(rows, '<i8'))
+            z.writestr("col.npy", npyArray(cols, '<i8'))
+            z.writestr("data.npy", npyArray(data, '<f8'))
+            z.writestr("samples.npy", npyArray(samples, '<U'))
+            z.writestr("taxa.npy", npyArray(taxa, '<U'))
+        os.replace(path + ".tmp", path)
+        logging.info(str(datetime.now()) + ": Wrote " + path + " (" + str(len(samples)) + " samples, " +
+                     str(len(taxa)) + " taxa)\n")
+
+
+# hands samples to the executor, each sample only once
+class SampleQueue:
+    def __init__(self, executor):
+        self.executor = executor
+        self.submitted = set()
+
+    def __call__(self, sample):
+        if sample in self.submitted:
+            return
+        self.submitted.add(sample)
+        self.executor.submit(sample)
+
+    def idle(self):
+        return self.executor.idle()
+
+
+# Executors process the samples handed to them (submit), tell whether all of them are finished (idle) and wait for
+# them (wait).
+# The local executor runs processSample in worker threads of this process.
+class LocalExecutor:
+    def __init__(self, workers, done=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures = list()
+        self.done = done
+
+    def submit(self, sample):
+        future = self.pool.submit(processSample, sample)
+        if self.done is not None:
+            future.add_done_callback(lambda f: self.done(sample))
+        self.futures.append(future)
+
+    def idle(self):
+        return all(f.done() for f in self.futures)
+
+    def wait(self):
+        self.pool.shutdown(wait=True)
+
+
+# The batch executor writes a job script per sample to jobs/ in the output directory and submits it. The job runs
+# MAPle for this one sample (--job) and records its state in jobs/<sample>.state on the shared file system; its
+# checkpoints, run report and QC store go to jobs/ as well and are merged into the ones of the run when all jobs
+# finished, so that the jobs never write to the same SQLite file over the network.
+class BatchExecutor:
+    def __init__(self, indir, outdir, config, done=None):
+        self.done = done
+        self.finished = set()
+        self.indir = indir
+        self.outdir = os.path.abspath(outdir)
+        self.config = os.path.abspath(config)
+        self.jobs = dict()
+        # job IDs of the scheduler and (modification time of the state file, time it was last checked)
+        self.ids = dict()
+        self.stamps = dict()
+        if not os.path.exists("jobs"):
+            os.makedirs("jobs", exist_ok=True)
+
+    def script(self, sample):
+        cores = variables["batchcores"]
+        lines = ["#!/bin/bash", "#SBATCH --job-name=maple_" + sample, "#SBATCH --cpus-per-task=" + str(cores),
+                 "#SBATCH --output=" + self.outdir + "/jobs/" + sample + ".out"]
+        if variables["memory"] > 0:
+            lines.append("#SBATCH --mem=" + str(int(math.ceil(variables["memory"]))) + "G")
+        for option in shlex.split(variables["batchoptions"]):
+            lines.append("#SBATCH " + option)
+        state = shlex.quote(self.outdir + "/jobs/" + sample + ".state")
+        command = [sys.executable, os.path.abspath(__file__), self.indir, self.outdir, self.config,
+                   "--job", sample, "--run", variables["run"], "--cores", str(cores)]
+        # settings of the run that are not in the config
+        for force in sorted(variables["force"]):
+            command += ["--force-stage", force]
+        if sample in previewScale:
+            command += ["--preview-scale", repr(previewScale[sample])]
+        lines += ["cd " + shlex.quote(self.outdir),
+                  " ".join(shlex.quote(c) for c in command) + " || echo '{\"state\": \"failed\"}' > " + state, ""]
+        path = "jobs/" + sample + ".sh"
+        with open(path, 'w') as j:
+            j.write("\n".join(lines))
+        os.chmod(path, 0o755)
+        return path
+
+    def submit(self, sample):
+        path = self.script(sample)
+        writeState(sample, "submitted")
+        if variables["batchsubmit"] == "local":
+            # stand-in for a scheduler: run the job in the background on this machine
+            with open("jobs/" + sample + ".out", 'w') as out:
+                process = subprocess.Popen(["bash", path], stdout=out, stderr=subprocess.STDOUT,
+                                           start_new_session=True)
+            self.jobs[sample] = process
+            logging.info("Started job " + path + " (pid " + str(process.pid) + ")\n")
+            return
+        result = subprocess.run(shlex.split(variables["batchsubmit"]) + [path], capture_output=True, text=True)
+        if result.returncode != 0:
+            logging.error("Could not submit " + path + ": " + result.stderr + "\n")
+            writeState(sample, "failed")
+        else:
+            logging.info("Submitted " + path + ": " + result.stdout.strip() + "\n")
+            jobid = re.search(r"\d+", result.stdout)
+            if jobid is not None:
+                self.ids[sample] = jobid.group(0)
+            else:
+                logging.warning("No job ID in the output of " + variables["batchsubmit"] + ", the job of sample " +
+                                sample + " is only followed through its state file\n")
+        self.jobs[sample] = None
+
+    def state(self, sample):
+        state = readState(sample)
+        process = self.jobs[sample]
+        if state not in ("done", "failed") and process is not None and process.poll() is not None:
+            # the job ended without recording its end
+            writeState(sample, "failed")
+            state = "failed"
+        if state not in ("done", "failed") and process is None and self.stale(sample):
+            ended = self.scheduled(sample)
+            # the job may have recorded its end just before it left the scheduler
+            state = readState(sample)
+            if ended is not None and state not in ("done", "failed"):
+                logging.error("Job " + self.ids[sample] + " of sample " + sample + " ended (" + ended +
+                              ") without recording its end\n")
+                writeState(sample, "failed")
+                state = "failed"
+        if state in ("done", "failed") and sample not in self.finished:
+            self.finished.add(sample)
+            if self.done is not None:
+                self.done(sample)
+        return state
+
+    # has the state file of a job not changed for batchpoll seconds
+    def stale(self, sample):
+        try:
+            stamp = os.stat("jobs/" + sample + ".state").st_mtime
+        except OSError:
+            stamp = None
+        last = self.stamps.get(sample)
+        if last is None or last[0] != stamp:
+            self.stamps[sample] = (stamp, time.time())
+            return False
+        if time.time() - last[1] < variables["batchpoll"]:
+            return False
+        self.stamps[sample] = (stamp, time.time())
+        return True
+
+    # ask the scheduler about the job of a sample: None while it is queued or running (or the scheduler could not
+    # be asked), otherwise the state it ended in ("unknown" if the scheduler no longer knows it)
+    def scheduled(self, sample):
+        if sample not in self.ids or variables["batchstatus"] == "":
+            return None
+        jobid = self.ids[sample]
+        try:
+            result = subprocess.run(shlex.split(variables["batchstatus"]) + [jobid], capture_output=True, text=True,
+                                    timeout=60)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.warning("Could not check job " + jobid + " of sample " + sample + ": " + str(e) + "\n")
+            return None
+        if result.returncode != 0 and "invalid job id" not in result.stderr.lower():
+            logging.warning("Could not check job " + jobid + " of sample " + sample + ": " + result.stderr + "\n")
+            return None
+        states = result.stdout.split()
+        if len(states) == 0:
+            return "unknown"
+        if states[0].rstrip("+") in endedStates:
+            return states[0]
+        return None
+
+    def idle(self):
+        return all(self.state(sample) in ("done", "failed") for sample in self.jobs)
+
+    def wait(self):
+        while not self.idle():
+            time.sleep(variables["batchpoll"])
+        for sample in sorted(self.jobs):
+            logging.info("Job of sample " + sample + ": " + self.state(sample) + "\n")
+        self.collect()
+
+    # merge the checkpoints, run reports and QC stores of the jobs into the ones of the run
+    def collect(self):
+        for sample in sorted(self.jobs):
+            path = "jobs/" + sample + ".checkpoints.json"
+            if os.path.exists(path):
+                with open(path, 'r') as c:
+                    for key, record in json.load(c).items():
+                        if key.startswith(sample + "/"):
+                            checkpoints[key] = record
+            path = "jobs/" + sample + ".report.json"
+            if os.path.exists(path):
+                with open(path, 'r') as r:
+                    job = json.load(r)
+                report["commands"].extend(job.get("commands", []))
+                report["stages"].extend(job.get("stages", []))
+                memoryBudget.measure(job.get("commands", []))
+            path = "jobs/" + sample + ".qc.sqlite"
+            if os.path.exists(path):
+                mergeQc(path, sample)
+        with checkpointLock:
+            saveCheckpoints()
+
+
+# state of the batch job of a sample: submitted, running, done or failed
+def writeState(sample, state):
+    with open("jobs/" + sample + ".state.tmp", 'w') as f:
+        json.dump({"state": state, "host": socket.gethostname(), "time": str(datetime.now())}, f)
+    os.replace("jobs/" + sample + ".state.tmp", "jobs/" + sample + ".state")
+
+
+def readState(sample):
+    try:
+        with open("jobs/" + sample + ".state", 'r') as f:
+            return json.load(f)["state"]
+    except (OSError, ValueError):
+        return "unknown"
+
+
+# batch job: process one sample of a run that was set up by runAnalysis, on whatever node the scheduler chose
+def runJob(outdir, config, sample, cores=None, run=None, force=None, scale=None):
     readConfig(config)
-    samples = setupFiles(indir, outdir)
-    for s in samples:
-        # always run preprocessing
-        fastqc(s, "00_RAW", "paired")
-        t1 = readQC(s, "00_RAW", "raw")
-        if int(t1[2]) < variables["rawabsolute"]:
-            logging.error("Breakpoint: Raw QC for sample " + s + " failed with a read count of only " + t1[2] + "\n")
-            #loghandle.write("Breakpoint: Raw QC for sample " + s + " failed with a read count of only " + t1[2] + "\n")
-            continue
-        logging.info("Raw QC for sample: " + s + " (based on R2)\n")
-        #loghandle.write("Raw QC for sample: " + s + " (based on R2)\n")
-        logging.info(
-            "Minimal read length: " + t1[0] + ", maximal read length: " + t1[1] + ", number of reads: " + t1[2] + "\n")
-        #loghandle.write(
-        #    "Minimal read length: " + t1[0] + ", maximal read length: " + t1[1] + ", number of reads: " + t1[2] + "\n")
-        trim(s, "01_trimmed", "00_RAW")
-        fastqc(s + ".trimmed", "01_trimmed", "paired")
-        t2 = readQC(s + ".trimmed", "01_trimmed", "trimmed")
-        raw2trimloss = 1.0 - (float(t2[2]) / float(t1[2]))
-        if raw2trimloss > variables["raw2trimloss"]:
-            logging.error("Breakpoint: Trimmed QC for sample " + s + " failed with a loss of " + str(raw2trimloss) +
-                          " compared to raw read counts\n")
-            #loghandle.write("Breakpoint: Trimmed QC for sample " + s + " failed with a loss of " + str(raw2trimloss) +
-            #                " compared to raw read counts\n")
+    variables["run"] = run or ""
+    if cores is not None:
+        variables["cores"] = cores
+    variables["force"] = set(force or [])
+    previewScale.clear()
+    if scale is not None:
+        previewScale[sample] = scale
+    os.chdir(outdir)
+    mainLog("jobs/" + sample + ".log")
+    loadManifest()
+    loadCheckpoints()
+    memoryBudget.load()
+    # the job only writes files of its own, the run merges them
+    variables["checkpoints"] = "jobs/" + sample + ".checkpoints.json"
+    variables["report"] = "jobs/" + sample + ".report"
+    variables["qcstore"] = "jobs/" + sample + ".qc.sqlite"
+    writeState(sample, "running")
+    start = time.time()
+    coreBudget(1)
+    status = processSample(sample)
+    writeReport(time.time() - start)
+    writeState(sample, "failed" if "failed" in status.values() else "done")
 
-            continue
-        logging.info("Trimmed QC for sample: " + s + " (based on R2) \n")
-        #loghandle.write("Trimmed QC for sample: " + s + " (based on R2) \n")
-        logging.info(
-            "Minimal read length: " + t2[0] + ", maximal read length: " + t2[1] + ", number of reads: " + t2[2] + "\n")
-        #loghandle.write(
-        #    "Minimal read length: " + t2[0] + ", maximal read length: " + t2[1] + ", number of reads: " + t2[2] + "\n")
-
-        # run the different modules
-        # Basic Metagenomics
-        if variables["basic"]:
-            diamond(s, "02_basic_aligned", "01_trimmed")
-            daa2rma(s, "03_basic_megan", "02_basic_aligned")
-        # Host-Associated Data
-        if variables["filterHost"]:
-            filterHost(s, "02_host_filtered", "01_trimmed")
-            diamondFasta(s, "03_host_aligned", "02_host_filtered")
-            daa2rma(s, "04_host_megan", "03_host_aligned")
-        # Taxonomic Analysis
-        if variables["16S"]:
-            select16S(s, "02_16S_selected", "01_trimmed")
-            malt(s, "03_16S_aligned", "02_16S_selected")
+
+# run full analysis, the samples are processed in parallel within the core budget
+def runAnalysis(indir, outdir, config, cores=None, workers=None, force=None, preview=None, seed=None, watch=False,
+                executor=None):
+    global logfile
+    config = os.path.abspath(config)
+    readConfig(config)
+    if executor is not None:
+        variables["executor"] = executor
+    if cores is not None:
+        variables["cores"] = cores
+    if workers is not None:
+        variables["workers"] = workers
+    variables["force"] = set(force or [])
+    indir = os.path.abspath(indir)
+    messages = list()
+    if preview is not None:
+        # the preview runs on a subsample of the reads in its own output tree
+        outdir = outdir.rstrip("/") + "_preview"
+        indir, messages = previewInput(indir, outdir, preview, seed)
+    else:
+        previewScale.clear()
+    samples = setupFiles(indir, outdir, watch)
+    for message in messages:
+        logging.info(message)
+    if len(samples) == 0 and not watch:
+        return
+    loadCheckpoints()
+    memoryBudget.load()
+    storeRun(os.getcwd())
+    if variables["cachedir"] != "" and not os.path.exists(variables["cachedir"]):
+        os.makedirs(variables["cachedir"], exist_ok=True)
+    report["commands"] = list()
+    report["stages"] = list()
+    start = time.time()
+    # in watch mode the number of samples is not known yet
+    workers, threads = coreBudget((os.cpu_count() or 1) if watch else len(samples))
+    logging.info(str(datetime.now()) + ": Processing " + str(len(samples)) + " samples, " + str(workers) +
+                 " at a time with " + str(threads) + " threads per tool\n")
+    # the abundance matrices grow as the samples finish
+    done = AbundanceMatrix("05_abundance").add if variables["abundance"] else None
+    if variables["executor"] == "batch":
+        executor = BatchExecutor(indir, os.getcwd(), config, done)
+    else:
+        executor = LocalExecutor(workers, done)
+    submit = SampleQueue(executor)
+    # samples of an earlier run of this output directory (their finished stages are skipped)
+    for sample in samples:
+        submit(sample)
+    if watch:
+        watchInput(indir, submit)
+    executor.wait()
+    writeReport(time.time() - start)
+    memoryBudget.save()
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "cache":
+        cacheCommand(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "qc":
+        qcCommand(sys.argv[2:])
+        sys.exit(0)
     parser = argparse.ArgumentParser(description="MAPle - Metagenomic Analysis PipeLinE",
                                      epilog="For more information please read the MAPle manual, report bugs and problems to sina.beier@uni-tuebingen.de")
     parser.add_argument("indirectory", type=str, help='''Input directory''')
     parser.add_argument("outdirectory", type=str,
                         help='''Output directory (script will put renamed raw files in this directory and generate all the output here)''')
     parser.add_argument("config", type=str, help='''Config file including paths to tools and parameters.''')
+    parser.add_argument("--cores", type=int, default=None,
+                        help='''Total number of cores MAPle may use (overrides "cores" in the config, default: all)''')
+    parser.add_argument("--workers", type=int, default=None,
+                        help='''Number of samples processed at the same time (overrides "workers" in the config)''')
+    parser.add_argument("--force-stage", type=str, action="append", default=[], dest="force",
+                        help='''Run this stage (e.g. trim, diamond, malt) again even if its checkpoint is up to date,
+                        can be given several times''')
+    parser.add_argument("--preview", type=float, default=None,
+                        help='''Quick run on N read pairs per sample (or this fraction of them if below 1), written to
+                        <outdirectory>_preview''')
+    parser.add_argument("--seed", type=int, default=None, help='''Random seed for --preview''')
+    parser.add_argument("--executor", type=str, default=None, choices=["local", "batch"],
+                        help='''Process the samples on this machine or as batch jobs (overrides "executor" in the
+                        config)''')
+    parser.add_argument("--job", type=str, default=None,
+                        help='''Process only this sample of an output directory that is already set up (used by the
+                        job scripts of the batch executor)''')
+    parser.add_argument("--preview-scale", type=float, default=None, dest="previewscale",
+                        help='''Share of the reads of the --job sample in the preview subsample''')
+    parser.add_argument("--run", type=str, default=None, help='''Run the --job belongs to in the QC store''')
+    parser.add_argument("--watch", action="store_true",
+                        help='''Keep watching the input directory and process new samples as soon as both read files
+                        are complete''')
 
     args = parser.parse_args()
-    runAnalysis(args.indirectory, args.outdirectory, args.config)
+    if args.job is not None:
+        runJob(args.outdirectory, args.config, args.job, args.cores, args.run, args.force, args.previewscale)
+        sys.exit(0)
+    runAnalysis(args.indirectory, args.outdirectory, args.config, args.cores, args.workers, args.force, args.preview,
+                args.seed, args.watch, args.executor)
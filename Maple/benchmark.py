@@ -0,0 +1,287 @@
+"""
+MAPle benchmark - measures the overhead and scaling of the pipeline itself
+
+@author: Sina Beier
+
+Generates synthetic paired-end gzipped FASTQ files and stub executables for FastQC, prinseq++, DIAMOND, MALT,
+daa2rma, rma2info and metaxa2 that imitate the outputs and the runtime of the real tools, so no databases are
+needed. Then runAnalysis is timed end to end and per stage for every combination of sample count and workers.
+"""
+
+import os
+import sys
+import gzip
+import json
+import random
+import shutil
+import stat
+import tempfile
+import argparse
+import logging
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Maple
+
+# Shared part of all stubs. The runtime of a tool is modeled as a fixed startup time (loading an index for MALT and
+# DIAMOND) plus a cost per read, both come from the environment so they can be changed without writing new stubs.
+stubCommon = '''#!%(python)s
+import sys, os, gzip, io, time, zipfile
+
+def opener(path):
+    # the whole file is read at once, so named pipes work as input, too
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:2] == b'\\x1f\\x8b':
+        data = gzip.decompress(data)
+    return io.StringIO(data.decode())
+
+def arg(args, *names):
+    for n in names:
+        if n in args:
+            return args[args.index(n) + 1]
+
+def multi(args, name):
+    values = list()
+    if name in args:
+        i = args.index(name) + 1
+        while i < len(args) and not args[i].startswith('-'):
+            values.append(args[i])
+            i += 1
+    return values
+
+def simulate(reads, startup=0.0):
+    time.sleep(startup + float(os.environ.get("BENCH_STARTUP", "0")) +
+               reads * float(os.environ.get("BENCH_READCOST", "0")) / 1000000.0)
+
+args = sys.argv[1:]
+'''
+
+stubs = dict()
+stubs["fastqc"] = '''
+out = arg(args, '-o')
+for f in [a for a in args if not a.startswith('-') and a != out]:
+    lengths = list()
+    with opener(f) as h:
+        for i, line in enumerate(h):
+            if i % 4 == 1:
+                lengths.append(len(line.strip()))
+    simulate(len(lengths))
+    base = os.path.basename(f)
+    for ext in ('.fastq.gz', '.fq.gz', '.fastq', '.fq', '.gz'):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+            break
+    name = base + '_fastqc'
+    if lengths and min(lengths) != max(lengths):
+        seqlen = "%d-%d" % (min(lengths), max(lengths))
+    else:
+        seqlen = str(lengths[0] if lengths else 0)
+    with zipfile.ZipFile(os.path.join(out, name + '.zip'), 'w') as z:
+        z.writestr(name + '/fastqc_data.txt', "##FastQC\\t0.11.9\\n>>Basic Statistics\\tpass\\n#Measure\\tValue\\n"
+                   "Filename\\t%s\\nTotal Sequences\\t%d\\nSequence length\\t%s\\n>>END_MODULE\\n"
+                   % (os.path.basename(f), len(lengths), seqlen))
+    with open(os.path.join(out, name + '.html'), 'w') as h:
+        h.write('<html></html>')
+'''
+stubs["prinseq++"] = '''
+reads = 0
+for infile, outfile in ((arg(args, '-fastq'), arg(args, '-out_good')), (arg(args, '-fastq2'), arg(args, '-out_good2'))):
+    with opener(infile) as h, open(outfile, 'w') as out:
+        for i, line in enumerate(h):
+            out.write(line)
+            reads += i % 4 == 0
+simulate(reads)
+'''
+stubs["diamond"] = '''
+if args and args[0] == 'version':
+    print('diamond version 2.0.15')
+    sys.exit(0)
+query = arg(args, '-q', '--query')
+with opener(query) as h:
+    reads = sum(1 for line in h if line[:1] in ('@', '>'))
+simulate(reads, 0.2)
+with open(arg(args, '-a', '--daa', '-o'), 'w') as out:
+    out.write('DAA %s %d\\n' % (query, reads))
+'''
+stubs["malt-run"] = '''
+outputs = multi(args, '-o')
+unaligned = multi(args, '-ou')
+aligned = multi(args, '-oa')
+simulate(0, 1.0)
+for k, infile in enumerate(multi(args, '-i')):
+    with opener(infile) as h:
+        lines = h.read().splitlines()
+    step = 4 if lines and lines[0].startswith('@') else 2
+    simulate(len(lines) // step)
+    fasta = ''.join('>' + lines[j][1:] + '\\n' + lines[j + 1] + '\\n' for j in range(0, len(lines) - 1, step))
+    if outputs:
+        with open(outputs[k] if len(outputs) > k else outputs[0], 'w') as out:
+            out.write('RMA\\n')
+    if len(unaligned) > k:
+        with open(unaligned[k], 'w') as out:
+            out.write(fasta)
+    if len(aligned) > k:
+        open(aligned[k], 'w').close()
+'''
+stubs["tools/daa2rma"] = '''
+simulate(0)
+with open(arg(args, '-o'), 'w') as out:
+    out.write('RMA6 ' + ' '.join(multi(args, '-i')) + '\\n')
+'''
+stubs["tools/rma2info"] = '''
+simulate(0)
+with open(arg(args, '-o'), 'w') as out:
+    out.write('Bacteria\\t10\\nFirmicutes\\t5\\n')
+'''
+stubs["metaxa2"] = '''
+out = arg(args, '-o')
+with opener(arg(args, '-1')) as h:
+    lines = h.read().splitlines()
+simulate(len(lines) // 4)
+hits = range(0, len(lines) - 1, 12)
+with open(out + '.extraction.fasta', 'w') as f:
+    f.write(''.join('>' + lines[j][1:] + '\\n' + lines[j + 1] + '\\n' for j in hits))
+with open(out + '.taxonomy.txt', 'w') as f:
+    for j in hits:
+        f.write(lines[j][1:].split()[0] + '\\tBacteria;Firmicutes;Bacilli\\t100\\t100\\t60\\n')
+with open(out + '.level_2.txt', 'w') as f:
+    f.write('Bacteria;Firmicutes\\t%d\\n' % len(hits))
+'''
+
+
+# write the stub executables to bindir
+def writeStubs(bindir):
+    for name, body in stubs.items():
+        path = os.path.join(bindir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(stubCommon % {"python": sys.executable} + body)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+# write a config that runs all modules with the stubs
+def writeConfig(bindir, path, extra):
+    with open(path, 'w') as c:
+        c.write("FASTQC = " + os.path.join(bindir, "fastqc") + "\n")
+        c.write("prinseq = " + os.path.join(bindir, "prinseq++") + "\n")
+        c.write("diamond = " + os.path.join(bindir, "diamond") + "\n")
+        c.write("malt = " + os.path.join(bindir, "malt-run") + "\n")
+        c.write("megantools = " + os.path.join(bindir, "tools") + "\n")
+        c.write("metaxa = " + os.path.join(bindir, "metaxa2") + "\n")
+        c.write("pairID1 = _R1_\npairID2 = _R2_\n")
+        c.write("rawabsolute = 10\n")
+        c.write("filterHost = True\n16S = True\n")
+        for line in extra:
+            c.write(line + "\n")
+
+
+# generate synthetic paired-end gzipped FASTQ files, samples share their reads so sample count does not change the
+# work per sample
+def writeSamples(indir, nsamples, reads, seed):
+    rng = random.Random(seed)
+    mates = ([], [])
+    for r in range(reads):
+        for m in (0, 1):
+            length = rng.randint(80, 150)
+            seq = ''.join(rng.choice('ACGT') for _ in range(length))
+            qual = ''.join(chr(33 + rng.randint(20, 40)) for _ in range(length))
+            mates[m].append("@read" + str(r) + " " + str(m + 1) + ":N:0:1\n" + seq + "\n+\n" + qual + "\n")
+    data = [gzip.compress(''.join(m).encode(), 1) for m in mates]
+    for s in range(nsamples):
+        for m in (0, 1):
+            with open(os.path.join(indir, "B" + str(s) + "_S" + str(s + 1) + "_R" + str(m + 1) + "_001.fastq.gz"),
+                      'wb') as f:
+                f.write(data[m])
+
+
+# run the whole analysis once and collect its timings
+def runOnce(indir, outdir, config, cores, workers):
+    cwd = os.getcwd()
+    start = time.time()
+    try:
+        Maple.runAnalysis(indir, outdir, config, cores=cores, workers=workers)
+    finally:
+        wall = time.time() - start
+        os.chdir(cwd)
+        for handler in logging.getLogger().handlers[:]:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+    stages = dict()
+    for st in Maple.report["stages"]:
+        stages[st["stage"]] = stages.get(st["stage"], 0.0) + st["wall"]
+    tools = sum(c["wall"] for c in Maple.report["commands"])
+    return {"wall": round(wall, 3), "analysis": Maple.report.get("wall"), "stages": stages,
+            "tools": round(tools, 3), "maple": round(sum(stages.values()) - tools, 3)}
+
+
+# run the benchmark for all combinations of sample count and workers
+def benchmark(samples, workers, reads, cores, repeat, extra, keep):
+    tmp = tempfile.mkdtemp(prefix="maple-benchmark-")
+    results = list()
+    try:
+        bindir = os.path.join(tmp, "bin")
+        writeStubs(bindir)
+        config = os.path.join(tmp, "benchmark.config")
+        writeConfig(bindir, config, extra)
+        for n in samples:
+            indir = os.path.join(tmp, "in" + str(n))
+            os.makedirs(indir)
+            writeSamples(indir, n, reads, n)
+            for w in workers:
+                for r in range(repeat):
+                    outdir = os.path.join(tmp, "out" + str(n) + "_" + str(w) + "_" + str(r))
+                    result = runOnce(indir, outdir, config, cores, w)
+                    result.update({"samples": n, "workers": w, "reads": reads, "repeat": r,
+                                   "throughput": round(n / result["wall"], 3)})
+                    results.append(result)
+                    sys.stderr.write("%d samples, %d workers: %.2f s\n" % (n, w, result["wall"]))
+    finally:
+        if keep:
+            sys.stderr.write("Benchmark data kept in " + tmp + "\n")
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+# print the timings as table, the stages are sorted by their total time
+def printResults(results):
+    totals = dict()
+    for r in results:
+        for stage, wall in r["stages"].items():
+            totals[stage] = totals.get(stage, 0.0) + wall
+    stages = sorted(totals, key=lambda s: -totals[s])
+    print("%8s %8s %9s %9s %11s %9s %9s" % ("samples", "workers", "wall [s]", "tools [s]", "MAPle [s]",
+                                            "samples/s", "repeat") + "".join(" %12s" % s for s in stages))
+    for r in results:
+        print("%8d %8d %9.2f %9.2f %11.2f %9.2f %9d" % (r["samples"], r["workers"], r["wall"], r["tools"], r["maple"],
+                                                         r["throughput"], r["repeat"]) +
+              "".join(" %12.2f" % r["stages"].get(s, 0.0) for s in stages))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MAPle benchmark with synthetic data and stub tools",
+                                     epilog="Stage columns are the summed wall time of the stage over all samples, "
+                                            "MAPle is the time stages spent outside of the tools")
+    parser.add_argument("--samples", type=int, nargs="+", default=[1, 4, 8], help='''Sample counts to test''')
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help='''Worker counts to test''')
+    parser.add_argument("--reads", type=int, default=10000, help='''Read pairs per sample''')
+    parser.add_argument("--cores", type=int, default=None, help='''Core budget of the runs (default: all)''')
+    parser.add_argument("--repeat", type=int, default=1, help='''Runs per combination''')
+    parser.add_argument("--startup", type=float, default=0.0,
+                        help='''Seconds every stub tool call takes in addition to its own work''')
+    parser.add_argument("--readcost", type=float, default=0.0,
+                        help='''Microseconds every stub tool spends per read''')
+    parser.add_argument("--set", type=str, action="append", default=[], dest="extra",
+                        help='''Additional config line, e.g. "maltbatch = 4", can be given several times''')
+    parser.add_argument("--json", type=str, default=None, help='''Write the results to this JSON file''')
+    parser.add_argument("--keep", action="store_true", help='''Keep the generated data and output directories''')
+
+    args = parser.parse_args()
+    os.environ["BENCH_STARTUP"] = str(args.startup)
+    os.environ["BENCH_READCOST"] = str(args.readcost)
+    results = benchmark(args.samples, args.workers, args.reads, args.cores, args.repeat, args.extra, args.keep)
+    printResults(results)
+    if args.json is not None:
+        with open(args.json, 'w') as j:
+            json.dump(results, j, indent=1)